@@ -1,27 +1,118 @@
 import streamlit as st
-import pandas as pd
-import re
 from datetime import datetime
+import time
+import functools
+import csv
+import uuid
 import io
 import os
 import logging
+import threading
+from types import SimpleNamespace
 import psycopg2
 from psycopg2 import pool
+from psycopg2.errors import CheckViolation
+from psycopg2.extras import execute_values, RealDictCursor
 from dotenv import load_dotenv
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4, landscape
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
-import openpyxl
-from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
+from schema import aplicar_esquema
 
 # Configuração do Logging
 LOG_FILE = "erros.log"
-logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+@st.cache_resource(show_spinner=False)
+def configurar_logging():
+    """Configura o logging uma única vez por processo, e não a cada rerun do Streamlit."""
+    logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+configurar_logging()
+
+# Estilo Personalizado (CSS injetado a cada execução do script)
+ESTILO_PERSONALIZADO = """
+    <style>
+    .stButton > button {
+        background-color: #1E90FF;
+        color: white;
+        font-weight: bold;
+        border-radius: 5px;
+        padding: 10px;
+        width: 100%;
+    }
+    .stButton > button:hover {
+        background-color: #104E8B;
+    }
+    .stTextInput > div > input {
+        background-color: #FFFFFF;
+        color: black;
+    }
+    .stSelectbox > div > select {
+        background-color: #FFFFFF;
+        color: black;
+    }
+    </style>
+"""
 
 # Carregar variáveis de ambiente
 load_dotenv()
 
+# Valores monetários são NUMERIC no banco; a interface e os relatórios trabalham com float
+DEC2FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, "DEC2FLOAT",
+    lambda value, cursor: float(value) if value is not None else None
+)
+
+class _ConexaoFloat(psycopg2.extensions.connection):
+    """Conexão do pool que entrega NUMERIC como float, sem alterar o conversor global do psycopg2."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        psycopg2.extensions.register_type(DEC2FLOAT, self)
+
+@functools.lru_cache(maxsize=None)
+def _estilos_excel():
+    """Cria uma única vez por processo os estilos do relatório Excel, compartilhados entre as células."""
+    from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
+    thin = Side(style='thin')
+    return SimpleNamespace(
+        header_font=Font(bold=True, size=12, color="FFFFFF"),
+        header_fill=PatternFill(start_color="1E90FF", end_color="1E90FF", fill_type="solid"),
+        border=Border(left=thin, right=thin, top=thin, bottom=thin),
+        align_center=Alignment(horizontal='center', vertical='center'),
+        align_left=Alignment(horizontal='left', vertical='center', wrap_text=True),
+        bold=Font(bold=True),
+    )
+
+# Colunas do relatório Excel alinhadas à esquerda (textos longos); as demais são centralizadas
+_LEFT_COLS = frozenset({1, 2, 4, 8, 12, 13})
+
+# Marcador de NULL do COPY (opção NULL), distinto do campo vazio que o csv escreve para strings vazias
+_NULL_COPY = r"\N"
+
+class _LinhasCSV:
+    """Objeto-arquivo somente leitura que gera em CSV, sob demanda, as linhas de um iterável (para o COPY)."""
+    def __init__(self, linhas):
+        self._linhas = iter(linhas)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._pendente = ""
+        self.total = 0
+
+    def read(self, size=-1):
+        # Só converte as linhas necessárias para atender ao pedido: a memória não cresce com o volume importado
+        while size < 0 or len(self._pendente) < size:
+            linha = next(self._linhas, None)
+            if linha is None:
+                break
+            # None vira o marcador de NULL do COPY; strings vazias continuam sendo strings vazias
+            self._writer.writerow([_NULL_COPY if valor is None else valor for valor in linha])
+            self.total += 1
+            self._pendente += self._buffer.getvalue()
+            self._buffer.seek(0)
+            self._buffer.truncate()
+        if size < 0:
+            dados, self._pendente = self._pendente, ""
+        else:
+            dados, self._pendente = self._pendente[:size], self._pendente[size:]
+        return dados
+
 class DataService:
     """Gerencia todas as interações com o banco de dados PostgreSQL e a lógica de negócios."""
     def __init__(self):
@@ -32,9 +123,14 @@ class DataService:
             "host": os.getenv("DB_HOST"),
             "port": os.getenv("DB_PORT")
         }
-        # Configurar pool de conexões para suportar até 3 usuários
+        # Pool com trava: as sessões do Streamlit rodam em threads distintas do mesmo processo.
+        # Com muitos usuários, aponte DB_HOST/DB_PORT para um pgbouncer (pool_mode = transaction)
+        # e mantenha aqui um pool local modesto; o pgbouncer concentra as conexões no servidor.
+        # O pool fecha as conexões devolvidas acima de minconn: DB_MINCONN deve acompanhar a
+        # concorrência esperada, ou cada pico de uso refaz o handshake com o banco
         self.connection_pool = psycopg2.pool.ThreadedConnectionPool(
-            minconn=1, maxconn=3, **self.db_params
+            minconn=int(os.getenv("DB_MINCONN", 5)), maxconn=int(os.getenv("DB_MAXCONN", 20)),
+            connection_factory=_ConexaoFloat, **self.db_params
         )
         self.init_db()
 
@@ -54,55 +150,10 @@ class DataService:
         """Inicializa o banco de dados PostgreSQL com a estrutura necessária."""
         conn = self.get_connection()
         try:
-            with conn.cursor() as c:
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS planos_internos (
-                        codigo TEXT PRIMARY KEY
-                    );
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS naturezas_despesa (
-                        codigo TEXT PRIMARY KEY,
-                        plano_interno_codigo TEXT,
-                        FOREIGN KEY (plano_interno_codigo) REFERENCES planos_internos (codigo) ON DELETE CASCADE
-                    );
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS secoes_requisitantes (
-                        codigo TEXT PRIMARY KEY
-                    );
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS notas (
-                        numero TEXT PRIMARY KEY,
-                        valor REAL,
-                        valor_restante REAL,
-                        descricao TEXT,
-                        observacao TEXT,
-                        prazo TEXT,
-                        data_criacao TEXT,
-                        natureza_despesa_codigo TEXT,
-                        plano_interno_codigo TEXT,
-                        ptres_codigo TEXT,
-                        fonte_codigo TEXT,
-                        FOREIGN KEY (natureza_despesa_codigo) REFERENCES naturezas_despesa (codigo) ON DELETE CASCADE,
-                        FOREIGN KEY (plano_interno_codigo) REFERENCES planos_internos (codigo) ON DELETE CASCADE
-                    );
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS empenhos (
-                        id SERIAL PRIMARY KEY,
-                        numero_nota TEXT,
-                        valor REAL,
-                        descricao TEXT,
-                        data TEXT,
-                        secao_requisitante_codigo TEXT,
-                        FOREIGN KEY (numero_nota) REFERENCES notas (numero) ON DELETE CASCADE,
-                        FOREIGN KEY (secao_requisitante_codigo) REFERENCES secoes_requisitantes (codigo) ON DELETE SET NULL
-                    );
-                ''')
-                conn.commit()
+            # Mesma estrutura do data_service, executada só quando a versão registrada no banco é anterior
+            if aplicar_esquema(conn):
                 logging.info("Banco de dados inicializado com sucesso.")
+            conn.commit()
         except Exception as e:
             logging.error(f"Erro ao inicializar banco de dados: {e}")
             raise Exception(f"Não foi possível inicializar o banco: {e}")
@@ -110,10 +161,10 @@ class DataService:
             self.release_connection(conn)
 
     def load_data(self, query, params=None):
-        """Carrega dados do banco de dados com segurança."""
+        """Carrega dados do banco de dados com segurança, com cada linha como dicionário."""
         conn = self.get_connection()
         try:
-            with conn.cursor() as c:
+            with conn.cursor(cursor_factory=RealDictCursor) as c:
                 if params:
                     c.execute(query, params)
                 else:
@@ -125,10 +176,42 @@ class DataService:
         finally:
             self.release_connection(conn)
 
+    def iter_data(self, query, params=None, itersize=2000, work_mem=None, totais_query=None):
+        """Percorre o resultado de uma consulta em lotes por meio de um cursor no servidor.
+
+        Com totais_query, a linha de totais (em Decimal) é produzida antes das linhas, lida no mesmo snapshot."""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as c:
+                if totais_query:
+                    # Primeiro comando da transação: totais e linhas enxergam o mesmo snapshot
+                    c.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+                if work_mem:
+                    # SET LOCAL vale só para esta transação: a conexão volta ao pool com a configuração padrão
+                    c.execute("SET LOCAL work_mem = %s", (work_mem,))
+                if totais_query:
+                    # Somas exatas: neste cursor o NUMERIC volta a ser Decimal, em vez do float da conexão
+                    psycopg2.extensions.register_type(psycopg2.extensions.DECIMAL, c)
+                    c.execute(totais_query)
+                    totais = c.fetchone()
+            if totais_query:
+                yield totais
+            # Cursor nomeado: o servidor entrega as linhas em blocos de itersize em vez de todas de uma vez
+            with conn.cursor(name=f"s_{uuid.uuid4().hex}") as c:
+                c.itersize = itersize
+                c.execute(query, params)
+                yield from c
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Erro ao carregar dados ({query}): {e}")
+            raise Exception(f"Não foi possível ler os dados: {e}")
+        finally:
+            self.release_connection(conn)
+
     def load_planos_internos(self):
         """Carrega todos os planos internos."""
-        rows = self.load_data("SELECT codigo FROM planos_internos ORDER BY codigo")
-        return [{"codigo": r[0]} for r in rows]
+        return self.load_data("SELECT codigo FROM planos_internos ORDER BY codigo")
 
     def load_naturezas_despesa(self, plano_interno_codigo=None):
         """Carrega naturezas de despesa, opcionalmente filtrando por plano interno."""
@@ -137,13 +220,11 @@ class DataService:
         if plano_interno_codigo:
             query += " WHERE plano_interno_codigo = %s"
             params = (plano_interno_codigo,)
-        rows = self.load_data(query, params)
-        return [{"codigo": r[0], "plano_interno_codigo": r[1]} for r in rows]
+        return self.load_data(query, params)
 
     def load_secoes_requisitantes(self):
         """Carrega todas as seções requisitantes."""
-        rows = self.load_data("SELECT codigo FROM secoes_requisitantes ORDER BY codigo")
-        return [{"codigo": r[0]} for r in rows]
+        return self.load_data("SELECT codigo FROM secoes_requisitantes ORDER BY codigo")
 
     def load_notas(self, natureza_despesa_codigo=None):
         """Carrega todas as notas, opcionalmente filtrando por natureza da despesa."""
@@ -152,13 +233,7 @@ class DataService:
         if natureza_despesa_codigo:
             query = query.replace("ORDER BY", "WHERE natureza_despesa_codigo = %s ORDER BY")
             params = (natureza_despesa_codigo,)
-        rows = self.load_data(query, params)
-        return [{
-            "numero": r[0], "valor": r[1], "valor_restante": r[2], "descricao": r[3],
-            "observacao": r[4], "prazo": r[5], "data_criacao": r[6],
-            "natureza_despesa_codigo": r[7], "plano_interno_codigo": r[8],
-            "ptres_codigo": r[9], "fonte_codigo": r[10]
-        } for r in rows]
+        return self.load_data(query, params)
 
     def load_empenhos(self, numero_nota=None):
         """Carrega empenhos, opcionalmente filtrando por número de nota."""
@@ -167,11 +242,42 @@ class DataService:
         if numero_nota:
             query += " WHERE numero_nota = %s"
             params = (numero_nota,)
-        rows = self.load_data(query, params)
-        return [{
-            "id": r[0], "numero_nota": r[1], "valor": r[2], "descricao": r[3],
-            "data": r[4], "secao_requisitante_codigo": r[5]
-        } for r in rows]
+        return self.load_data(query, params)
+
+    # Linhas dos relatórios: uma por empenho, ou uma por nota sem empenhos
+    _REPORT_QUERY = """
+        SELECT COALESCE(p.codigo, 'N/A'), COALESCE(nd.codigo, 'N/A'), n.ptres_codigo, n.fonte_codigo,
+               n.numero, n.valor, n.valor_restante, n.descricao, n.prazo,
+               e.id, e.data, e.valor, e.descricao, COALESCE(s.codigo, 'N/A')
+        FROM notas n
+        LEFT JOIN naturezas_despesa nd ON nd.codigo = n.natureza_despesa_codigo
+        LEFT JOIN planos_internos p ON p.codigo = n.plano_interno_codigo
+        LEFT JOIN empenhos e ON e.numero_nota = n.numero
+        LEFT JOIN secoes_requisitantes s ON s.codigo = e.secao_requisitante_codigo
+        ORDER BY n.data_criacao DESC, n.numero, e.id
+    """
+
+    def load_report_rows(self):
+        """Percorre em uma única consulta as linhas dos relatórios."""
+        return self.iter_data(self._REPORT_QUERY, work_mem="64MB")
+
+    def load_report(self):
+        """Retorna os totais gerais, somados no servidor, e as linhas dos relatórios, lidas no mesmo snapshot."""
+        linhas = self.iter_data(self._REPORT_QUERY, work_mem="64MB", totais_query="""
+            SELECT COALESCE(SUM(valor), 0), COALESCE(SUM(valor_restante), 0),
+                   (SELECT COALESCE(SUM(valor), 0) FROM empenhos WHERE numero_nota IS NOT NULL)
+            FROM notas
+        """)
+        # A primeira linha produzida são os totais; as demais seguem em fluxo pela mesma conexão
+        return next(linhas), linhas
+
+    def load_report_df(self):
+        """Carrega as linhas do relatório em um DataFrame, montado direto do cursor em fluxo."""
+        import pandas as pd  # importado sob demanda: só as páginas de relatório usam pandas
+        return pd.DataFrame.from_records(self.load_report_rows(), columns=[
+            "plano", "natureza", "ptres_codigo", "fonte_codigo", "numero", "valor", "valor_restante",
+            "descricao", "prazo", "empenho_id", "data_empenho", "valor_empenho", "descricao_empenho", "secao"
+        ])
 
     def save_plano_interno(self, plano_interno):
         """Salva um novo plano interno."""
@@ -253,28 +359,114 @@ class DataService:
         finally:
             self.release_connection(conn)
 
-    def save_empenho(self, empenho, nota):
-        """Salva um empenho e atualiza o valor restante da nota."""
+    def save_empenho(self, empenho):
+        """Salva um empenho, cujo valor o trigger desconta do saldo da nota, retornando o novo valor restante."""
         conn = self.get_connection()
         try:
             with conn.cursor() as c:
+                # Inserção e leitura do saldo atualizado pelo trigger em uma única ida ao banco
                 c.execute("""
                     INSERT INTO empenhos (numero_nota, valor, descricao, data, secao_requisitante_codigo)
-                    VALUES (%s, %s, %s, %s, %s)
+                    VALUES (%s, %s, %s, %s, %s);
+                    SELECT valor_restante FROM notas WHERE numero = %s
                 """, (
                     empenho["numero_nota"], empenho["valor"], empenho["descricao"],
-                    empenho["data"], empenho["secao_requisitante_codigo"]
+                    empenho["data"], empenho["secao_requisitante_codigo"], empenho["numero_nota"]
                 ))
-                c.execute("UPDATE notas SET valor_restante = %s WHERE numero = %s",
-                          (nota["valor_restante"], nota["numero"]))
+                valor_restante = c.fetchone()[0]
                 conn.commit()
             logging.info(f"Empenho de R${empenho['valor']:.2f} registrado para nota {empenho['numero_nota']}.")
+            return valor_restante
+        except CheckViolation:
+            logging.error(f"Empenho de R${empenho['valor']:.2f} excede o saldo da nota {empenho['numero_nota']}.")
+            raise ValueError("Valor do empenho excede o saldo restante da nota.")
         except Exception as e:
             logging.error(f"Erro ao salvar empenho: {e}")
             raise
         finally:
             self.release_connection(conn)
 
+    def save_notas_bulk(self, notas):
+        """Salva várias notas em um único INSERT multi-VALUES e uma única transação."""
+        # Lista montada antes da ida ao banco: aceita geradores e dá a contagem para o log
+        linhas = [(
+            n["numero"], n["valor"], n["valor_restante"], n["descricao"],
+            n["observacao"], n["prazo"], n["data_criacao"],
+            n["natureza_despesa_codigo"], n["plano_interno_codigo"],
+            n["ptres_codigo"], n["fonte_codigo"]
+        ) for n in notas]
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as c:
+                execute_values(c, """
+                    INSERT INTO notas (numero, valor, valor_restante, descricao, observacao, prazo, data_criacao,
+                                       natureza_despesa_codigo, plano_interno_codigo, ptres_codigo, fonte_codigo)
+                    VALUES %s
+                """, linhas, page_size=500)
+                conn.commit()
+            logging.info(f"{len(linhas)} notas salvas em lote com sucesso.")
+        except psycopg2.IntegrityError as e:
+            logging.error(f"Erro de integridade ao salvar notas em lote: {e}")
+            raise ValueError(f"Não foi possível salvar as notas: {e}")
+        except Exception as e:
+            logging.error(f"Erro ao salvar notas em lote: {e}")
+            raise
+        finally:
+            self.release_connection(conn)
+
+    def save_empenhos_bulk(self, empenhos):
+        """Salva vários empenhos em uma única transação; o trigger da tabela abate os valores das notas."""
+        linhas = [(
+            e["numero_nota"], e["valor"], e["descricao"],
+            e["data"], e["secao_requisitante_codigo"]
+        ) for e in empenhos]
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as c:
+                execute_values(c, """
+                    INSERT INTO empenhos (numero_nota, valor, descricao, data, secao_requisitante_codigo)
+                    VALUES %s
+                """, linhas, page_size=500)
+                conn.commit()
+            logging.info(f"{len(linhas)} empenhos registrados em lote com sucesso.")
+        except CheckViolation:
+            logging.error("Empenhos em lote excedem o saldo de ao menos uma nota.")
+            raise ValueError("Valor dos empenhos excede o saldo restante de ao menos uma nota.")
+        except Exception as e:
+            logging.error(f"Erro ao salvar empenhos em lote: {e}")
+            raise
+        finally:
+            self.release_connection(conn)
+
+    def bulk_import_notas(self, notas):
+        """Importa um grande volume de notas pelo protocolo COPY, o caminho de carga mais rápido do PostgreSQL."""
+        # As linhas são convertidas em CSV à medida que o COPY as lê, sem montar o arquivo inteiro em memória
+        buffer = _LinhasCSV((
+            n["numero"], n["valor"], n["valor_restante"], n["descricao"],
+            n["observacao"], n["prazo"], n["data_criacao"],
+            n["natureza_despesa_codigo"], n["plano_interno_codigo"],
+            n["ptres_codigo"], n["fonte_codigo"]
+        ) for n in notas)
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as c:
+                # COPY dispara triggers e valida constraints, mas ignora RULEs definidas na tabela
+                c.copy_expert("""
+                    COPY notas (numero, valor, valor_restante, descricao, observacao, prazo, data_criacao,
+                                natureza_despesa_codigo, plano_interno_codigo, ptres_codigo, fonte_codigo)
+                    FROM STDIN WITH (FORMAT CSV, NULL '\\N')
+                """, buffer)
+                conn.commit()
+            logging.info(f"{buffer.total} notas importadas via COPY com sucesso.")
+        except psycopg2.IntegrityError as e:
+            logging.error(f"Erro de integridade ao importar notas: {e}")
+            raise ValueError(f"Não foi possível importar as notas: {e}")
+        except Exception as e:
+            logging.error(f"Erro ao importar notas: {e}")
+            raise
+        finally:
+            self.release_connection(conn)
+
     def delete_plano_interno(self, codigo):
         """Deleta um plano interno."""
         conn = self.get_connection()
@@ -323,6 +515,8 @@ class DataService:
         try:
             with conn.cursor() as c:
                 c.execute("DELETE FROM notas WHERE numero = %s", (numero_nota,))
+                if c.rowcount == 0:
+                    raise ValueError("Nota não encontrada.")
                 conn.commit()
             logging.info(f"Nota {numero_nota} deletada com sucesso.")
         except Exception as e:
@@ -332,18 +526,13 @@ class DataService:
             self.release_connection(conn)
 
     def delete_empenho(self, empenho_id):
-        """Deleta um empenho e atualiza o valor restante da nota associada."""
+        """Deleta um empenho; o trigger da tabela devolve seu valor ao saldo da nota."""
         conn = self.get_connection()
         try:
             with conn.cursor() as c:
-                c.execute("SELECT numero_nota, valor FROM empenhos WHERE id = %s", (empenho_id,))
-                empenho = c.fetchone()
-                if not empenho:
-                    raise ValueError("Empenho não encontrado.")
-                numero_nota, valor_empenho = empenho
-                c.execute("UPDATE notas SET valor_restante = valor_restante + %s WHERE numero = %s",
-                          (valor_empenho, numero_nota))
                 c.execute("DELETE FROM empenhos WHERE id = %s", (empenho_id,))
+                if c.rowcount == 0:
+                    raise ValueError("Empenho não encontrado.")
                 conn.commit()
             logging.info(f"Empenho {empenho_id} deletado com sucesso.")
         except Exception as e:
@@ -353,112 +542,102 @@ class DataService:
             self.release_connection(conn)
 
     def generate_excel_report(self):
-        """Gera relatório em Excel com uma linha por empenho, incluindo a hierarquia."""
-        notas = self.load_notas()
-        empenhos = self.load_empenhos()
-        naturezas = self.load_naturezas_despesa()
-        planos = self.load_planos_internos()
-        secoes = self.load_secoes_requisitantes()
-
-        total_valor_geral = sum(n["valor"] for n in notas)
-        total_restante_geral = sum(n["valor_restante"] for n in notas)
-        total_empenhado_geral = sum(e["valor"] for e in empenhos)
-
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Relatório Detalhado de Empenhos"
-
-        header_font = Font(bold=True, size=12, color="FFFFFF")
-        header_fill = PatternFill(start_color="1E90FF", end_color="1E90FF", fill_type="solid")
-        border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-        align_center = Alignment(horizontal='center', vertical='center')
-        align_left = Alignment(horizontal='left', vertical='center', wrap_text=True)
+        """Gera relatório em Excel com uma linha por empenho, incluindo a hierarquia, e retorna seus bytes."""
+        # Totais do mesmo snapshot das linhas: o rodapé sempre confere com a tabela acima dele
+        totais, report_rows = self.load_report()
+
+        # Importações sob demanda: openpyxl só é carregado quando um relatório é gerado
+        import openpyxl
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.utils import get_column_letter
+        estilos = _estilos_excel()
+
+        # Modo write-only: as células são estilizadas ao serem escritas e descartadas após o flush
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("Relatório Detalhado de Empenhos")
 
         headers = [
             "Plano Interno", "Natureza da Despesa", "PTRES", "Fonte",
             "Nº Nota", "Valor Original (R$)", "Valor Restante (R$)", "Descrição da Nota", "Prazo",
             "Data Empenho", "Valor Empenho (R$)", "Descrição Empenho", "Seção Requisitante"
         ]
-        ws.append(headers)
-
-        for cell in ws[1]:
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = align_center
-            cell.border = border
-
-        for nota in notas:
-            natureza = next((n for n in naturezas if n["codigo"] == nota["natureza_despesa_codigo"]), {"codigo": "N/A", "plano_interno_codigo": None})
-            plano = next((p for p in planos if p["codigo"] == natureza["plano_interno_codigo"]), {"codigo": "N/A"}) if natureza["plano_interno_codigo"] else {"codigo": "N/A"}
-
-            related_empenhos = [e for e in empenhos if e["numero_nota"] == nota["numero"]]
-            if not related_empenhos:
-                row_data = [
-                    plano["codigo"], natureza["codigo"], nota["ptres_codigo"], nota["fonte_codigo"],
-                    nota["numero"], nota["valor"], nota["valor_restante"], nota["descricao"], nota["prazo"],
-                    "Nenhum empenho", "", "", "N/A"
-                ]
-                ws.append(row_data)
-            else:
-                for empenho in related_empenhos:
-                    secao = next((s for s in secoes if s["codigo"] == empenho["secao_requisitante_codigo"]), {"codigo": "N/A"}) if empenho["secao_requisitante_codigo"] else {"codigo": "N/A"}
-                    row_data = [
-                        plano["codigo"], natureza["codigo"], nota["ptres_codigo"], nota["fonte_codigo"],
-                        nota["numero"], nota["valor"], nota["valor_restante"], nota["descricao"], nota["prazo"],
-                        empenho["data"], empenho["valor"], empenho["descricao"], secao["codigo"]
-                    ]
-                    ws.append(row_data)
-
-        for row in ws.iter_rows(min_row=2, max_row=ws.max_row):
-            for cell in row:
-                cell.border = border
-                cell.alignment = align_left if cell.column in [1, 2, 4, 8, 12, 13] else align_center
+
+        # Larguras fixas: com as linhas em fluxo não há como medi-las antes da primeira escrita,
+        # e o modo write-only exige que sejam definidas antes dela
+        col_widths = [18, 25, 10, 14, 12, 22, 22, 40, 12, 22, 20, 40, 22]
+        for i, width in enumerate(col_widths, start=1):
+            ws.column_dimensions[get_column_letter(i)].width = width
+
+        header_cells = []
+        for value in headers:
+            cell = WriteOnlyCell(ws, value=value)
+            cell.font = estilos.header_font
+            cell.fill = estilos.header_fill
+            cell.alignment = estilos.align_center
+            cell.border = estilos.border
+            header_cells.append(cell)
+        ws.append(header_cells)
+
+        for (plano, natureza, ptres, fonte, numero, valor, valor_restante, descricao, prazo,
+             empenho_id, empenho_data, empenho_valor, empenho_descricao, secao) in report_rows:
+            # Notas sem empenho vêm da junção externa com as colunas do empenho nulas (e seção 'N/A')
+            sem_empenho = empenho_id is None
+            row_data = [
+                plano, natureza, ptres, fonte, numero, valor, valor_restante, descricao, prazo,
+                "Nenhum empenho" if sem_empenho else empenho_data,
+                "" if sem_empenho else empenho_valor,
+                "" if sem_empenho else empenho_descricao,
+                secao
+            ]
+            cells = []
+            for col, value in enumerate(row_data, start=1):
+                cell = WriteOnlyCell(ws, value=value)
+                cell.border = estilos.border
+                cell.alignment = estilos.align_left if col in _LEFT_COLS else estilos.align_center
+                cells.append(cell)
+            ws.append(cells)
+
+        total_valor_geral, total_restante_geral, total_empenhado_geral = totais
+        totals_row = [None] * len(headers)
+        totals_row[0] = "TOTAIS GERAIS"
+        totals_row[5] = total_valor_geral
+        totals_row[6] = total_restante_geral
+        totals_row[10] = total_empenhado_geral
 
         ws.append([])  # Linha em branco
-        total_row_idx = ws.max_row + 1
-        ws.cell(row=total_row_idx, column=1, value="TOTAIS GERAIS").font = header_font
-        ws.cell(row=total_row_idx, column=6, value=total_valor_geral).font = Font(bold=True)
-        ws.cell(row=total_row_idx, column=7, value=total_restante_geral).font = Font(bold=True)
-        ws.cell(row=total_row_idx, column=11, value=total_empenhado_geral).font = Font(bold=True)
-
-        for col in range(1, len(headers) + 1):
-            ws.cell(row=total_row_idx, column=col).border = border
-            ws.cell(row=total_row_idx, column=col).alignment = align_center
-        ws.cell(row=total_row_idx, column=1).fill = header_fill
-
-        for col in ws.columns:
-            max_length = 0
-            for cell in col:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = (max_length + 2) * 1.2
-            ws.column_dimensions[col[0].column_letter].width = min(adjusted_width, 50)
-
-        filename = "relatorios/relatorio_notas_credito.xlsx"
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        wb.save(filename)
+        total_cells = []
+        for col, value in enumerate(totals_row, start=1):
+            cell = WriteOnlyCell(ws, value=value)
+            cell.border = estilos.border
+            cell.alignment = estilos.align_center
+            if col == 1:
+                cell.font = estilos.header_font
+                cell.fill = estilos.header_fill
+            elif value is not None:
+                cell.font = estilos.bold
+            total_cells.append(cell)
+        ws.append(total_cells)
+
+        buffer = io.BytesIO()
+        wb.save(buffer)
         logging.info("Relatório Excel gerado com sucesso.")
-        return filename
+        return buffer.getvalue()
 
     def generate_pdf_report(self):
-        """Gera relatório em PDF com uma linha por empenho, incluindo a hierarquia."""
-        notas = self.load_notas()
-        empenhos = self.load_empenhos()
-        naturezas = self.load_naturezas_despesa()
-        planos = self.load_planos_internos()
-        secoes = self.load_secoes_requisitantes()
-
-        total_valor_geral = sum(n["valor"] for n in notas)
-        total_restante_geral = sum(n["valor_restante"] for n in notas)
-        total_empenhado_geral = sum(e["valor"] for e in empenhos)
-
-        filename = "relatorios/relatorio_notas_credito.pdf"
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        doc = SimpleDocTemplate(filename, pagesize=landscape(A4))
+        """Gera relatório em PDF com uma linha por empenho, incluindo a hierarquia, e retorna seus bytes."""
+        # Totais do mesmo snapshot das linhas: o rodapé sempre confere com a tabela acima dele
+        totais, report_rows = self.load_report()
+
+        # Importações sob demanda: reportlab só é carregado quando um relatório é gerado
+        from reportlab.lib import colors
+        from reportlab.lib.pagesizes import A4, landscape
+        from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+        from reportlab.lib.styles import getSampleStyleSheet
+
+        buffer = io.BytesIO()
+        doc = SimpleDocTemplate(buffer, pagesize=landscape(A4))
         styles = getSampleStyleSheet()
+        body_style = styles['BodyText']
         elements = []
 
         headers = [
@@ -467,34 +646,20 @@ class DataService:
         ]
         data = [headers]
 
-        for nota in notas:
-            natureza = next((n for n in naturezas if n["codigo"] == nota["natureza_despesa_codigo"]), {"codigo": "N/A", "plano_interno_codigo": None})
-            plano = next((p for p in planos if p["codigo"] == natureza["plano_interno_codigo"]), {"codigo": "N/A"}) if natureza["plano_interno_codigo"] else {"codigo": "N/A"}
-
-            related_empenhos = [e for e in empenhos if e["numero_nota"] == nota["numero"]]
-            if not related_empenhos:
-                data.append([
-                    Paragraph(plano["codigo"], styles['BodyText']),
-                    Paragraph(natureza["codigo"], styles['BodyText']),
-                    Paragraph(nota["ptres_codigo"], styles['BodyText']),
-                    Paragraph(nota["fonte_codigo"], styles['BodyText']),
-                    Paragraph(nota["numero"], styles['BodyText']),
-                    f"R$ {nota['valor']:.2f}", f"R$ {nota['valor_restante']:.2f}",
-                    "Nenhum", "", Paragraph(nota["descricao"], styles['BodyText']), "N/A"
-                ])
-            else:
-                for empenho in related_empenhos:
-                    secao = next((s for s in secoes if s["codigo"] == empenho["secao_requisitante_codigo"]), {"codigo": "N/A"}) if empenho["secao_requisitante_codigo"] else {"codigo": "N/A"}
-                    data.append([
-                        Paragraph(plano["codigo"], styles['BodyText']),
-                        Paragraph(natureza["codigo"], styles['BodyText']),
-                        Paragraph(nota["ptres_codigo"], styles['BodyText']),
-                        Paragraph(nota["fonte_codigo"], styles['BodyText']),
-                        Paragraph(nota["numero"], styles['BodyText']),
-                        f"R$ {nota['valor']:.2f}", f"R$ {nota['valor_restante']:.2f}",
-                        empenho["data"], f"R$ {empenho['valor']:.2f}", Paragraph(empenho["descricao"], styles['BodyText']),
-                        Paragraph(secao["codigo"], styles['BodyText'])
-                    ])
+        for (plano, natureza, ptres, fonte, numero, valor, valor_restante, descricao, prazo,
+             empenho_id, empenho_data, empenho_valor, empenho_descricao, secao) in report_rows:
+            # Códigos curtos vão como texto simples; Paragraph (com quebra de linha) só nas descrições.
+            # Notas sem empenho vêm da junção externa com as colunas do empenho nulas (e seção 'N/A')
+            sem_empenho = empenho_id is None
+            data.append([
+                plano, natureza, ptres, fonte, numero,
+                f"R$ {valor:.2f}", f"R$ {valor_restante:.2f}",
+                "Nenhum" if sem_empenho else empenho_data,
+                "" if sem_empenho else f"R$ {empenho_valor:.2f}",
+                Paragraph(descricao if sem_empenho else empenho_descricao, body_style),
+                secao
+            ])
+        total_valor_geral, total_restante_geral, total_empenhado_geral = totais
 
         table = Table(data, colWidths=[80, 80, 80, 80, 80, 80, 80, 100, 80, 180, 80])
         table.setStyle(TableStyle([
@@ -529,22 +694,101 @@ class DataService:
 
         doc.build(elements)
         logging.info("Relatório PDF gerado com sucesso.")
-        return filename
+        return buffer.getvalue()
 
 # Configuração da Página Streamlit
 st.set_page_config(page_title="Controle de Notas de Crédito", layout="wide")
 st.title("Controle de Notas de Crédito")
 
 # Inicialização do DataService
+@st.cache_resource
+def get_data_service():
+    """Cria o DataService (e seu pool de conexões) uma única vez por processo."""
+    return DataService()
+
 try:
-    data_service = DataService()
+    data_service = get_data_service()
 except Exception as e:
     st.error(f"Erro ao inicializar a aplicação: {e}")
     st.stop()
 
+# Leituras em cache, indexadas pela versão dos dados: uma gravação muda a chave e as entradas antigas expiram sozinhas
+CACHE_TTL = 300
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def _load_planos(versao):
+    return data_service.load_planos_internos()
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def _load_naturezas(versao, plano_interno_codigo=None):
+    return data_service.load_naturezas_despesa(plano_interno_codigo)
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def _load_secoes(versao):
+    return data_service.load_secoes_requisitantes()
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def _load_notas(versao):
+    return data_service.load_notas()
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def _load_empenhos(versao):
+    return data_service.load_empenhos()
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def _load_relatorio(versao):
+    return data_service.load_report_df()
+
+@st.cache_resource
+def _versao_dados():
+    """Versão dos dados compartilhada entre as sessões, incrementada a cada gravação."""
+    return {"valor": 0, "lock": threading.Lock()}
+
+# Arquivos gerados ficam em cache por versão dos dados: cliques repetidos sem gravações no meio reutilizam os bytes
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=2)
+def _gerar_excel(versao):
+    return data_service.generate_excel_report()
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=2)
+def _gerar_pdf(versao):
+    return data_service.generate_pdf_report()
+
+def _dados_sessao(chave, loader):
+    """Mantém os dados em st.session_state até que a versão mude ou passe CACHE_TTL; o loader recebe a versão como chave."""
+    versao = _versao_dados()["valor"]
+    if (st.session_state.get(f"_{chave}_versao") != versao
+            or time.monotonic() - st.session_state[f"_{chave}_carga"] > CACHE_TTL):
+        st.session_state[chave] = loader(versao)
+        st.session_state[f"_{chave}_versao"] = versao
+        st.session_state[f"_{chave}_carga"] = time.monotonic()
+    return st.session_state[chave]
+
+def _invalidar_cache():
+    """Avança a versão dos dados; as próximas leituras usam a nova versão como chave do cache."""
+    versao = _versao_dados()
+    with versao["lock"]:
+        versao["valor"] += 1
+
+def _indexar_naturezas(naturezas):
+    """Agrupa os códigos das naturezas por plano interno, uma vez por versão dos dados."""
+    por_plano = {}
+    for n in naturezas:
+        por_plano.setdefault(n["plano_interno_codigo"], []).append(n["codigo"])
+    return por_plano
+
+def _rotulos_notas(notas):
+    """Monta os rótulos das notas para os selectboxes, formatados uma vez por versão dos dados."""
+    return {n["numero"]: f'{n["numero"]} (Saldo: R${n["valor_restante"]:.2f})' for n in notas}
+
 # Funções de Validação
 def validar_data(data_str):
     """Valida se uma string está no formato DD/MM/AAAA."""
+    # Pré-checagem barata: entradas malformadas são rejeitadas sem passar pela exceção do strptime
+    if len(data_str) != 10 or data_str[2] != "/" or data_str[5] != "/":
+        return False
+    digitos = data_str[:2] + data_str[3:5] + data_str[6:]
+    if not (digitos.isascii() and digitos.isdecimal()):
+        return False
     try:
         datetime.strptime(data_str, "%d/%m/%Y")
         return True
@@ -553,71 +797,33 @@ def validar_data(data_str):
 
 def validar_numerico(valor):
     """Valida se o valor é numérico."""
+    if not valor:
+        return None
     try:
-        return float(valor.replace(',', '.')) if valor else None
+        return float(valor.replace(',', '.') if ',' in valor else valor)
     except ValueError:
         return None
 
 def validar_ptres(ptres):
     """Valida PTRES: exatamente 6 dígitos."""
-    return ptres.isdigit() and len(ptres) == 6
+    return len(ptres) == 6 and ptres.isascii() and ptres.isdecimal()
 
 def validar_fonte(fonte):
     """Valida Fonte: exatamente 10 dígitos."""
-    return fonte.isdigit() and len(fonte) == 10
+    return len(fonte) == 10 and fonte.isascii() and fonte.isdecimal()
 
 def validar_nota_numero(numero):
     """Valida Número da Nota: NC + 6 dígitos."""
-    return bool(re.match(r"^NC\d{6}$", numero))
-
-# Barra Lateral de Navegação
-menu = [
-    "🏠 Início",
-    "📋 Adicionar Plano Interno",
-    "📋 Adicionar Natureza da Despesa",
-    "📋 Adicionar Seção Requisitante",
-    "➕ Adicionar Nota",
-    "📉 Registrar Empenho",
-    "🗑️ Deletar Nota",
-    "🗑️ Deletar Empenho",
-    "📊 Visualizar Relatório",
-    "📊 Empenhos por Seção",
-    "📑 Relatório Excel",
-    "📄 Relatório PDF"
-]
-opcao = st.sidebar.selectbox("Menu", menu)
-
-# Estilo Personalizado
-st.markdown("""
-    <style>
-    .stButton > button {
-        background-color: #1E90FF;
-        color: white;
-        font-weight: bold;
-        border-radius: 5px;
-        padding: 10px;
-        width: 100%;
-    }
-    .stButton > button:hover {
-        background-color: #104E8B;
-    }
-    .stTextInput > div > input {
-        background-color: #FFFFFF;
-        color: black;
-    }
-    .stSelectbox > div > select {
-        background-color: #FFFFFF;
-        color: black;
-    }
-    </style>
-""", unsafe_allow_html=True)
+    return len(numero) == 8 and numero.isascii() and numero[:2] == "NC" and numero[2:].isdecimal()
 
-# Funções da Interface
-if opcao == "🏠 Início":
+# Páginas da Interface
+def pagina_inicio():
+    """Página inicial."""
     st.header("Bem-vindo ao Controle de Notas de Crédito")
     st.write("Use o menu lateral para gerenciar notas de crédito, empenhos e relatórios.")
 
-elif opcao == "📋 Adicionar Plano Interno":
+def pagina_adicionar_plano_interno():
+    """Formulário de cadastro de plano interno."""
     st.header("Adicionar Plano Interno")
     with st.form("form_plano_interno"):
         codigo = st.text_input("Código (ex: PI001)")
@@ -628,15 +834,17 @@ elif opcao == "📋 Adicionar Plano Interno":
                     st.error("O campo código não pode estar vazio.")
                 else:
                     data_service.save_plano_interno({"codigo": codigo.upper()})
+                    _invalidar_cache()
                     st.success(f"Plano Interno {codigo} adicionado com sucesso!")
             except ValueError as e:
                 st.error(str(e))
             except Exception as e:
                 st.error(f"Ocorreu um erro: {e}")
 
-elif opcao == "📋 Adicionar Natureza da Despesa":
+def pagina_adicionar_natureza_despesa():
+    """Formulário de cadastro de natureza da despesa."""
     st.header("Adicionar Natureza da Despesa")
-    planos = data_service.load_planos_internos()
+    planos = _dados_sessao("planos", _load_planos)
     if not planos:
         st.warning("Nenhum plano interno cadastrado. Cadastre um plano interno primeiro.")
     else:
@@ -653,13 +861,15 @@ elif opcao == "📋 Adicionar Natureza da Despesa":
                             "codigo": codigo,
                             "plano_interno_codigo": plano_codigo
                         })
+                        _invalidar_cache()
                         st.success(f"Natureza da Despesa {codigo} adicionada com sucesso!")
                 except ValueError as e:
                     st.error(str(e))
                 except Exception as e:
                     st.error(f"Ocorreu um erro: {e}")
 
-elif opcao == "📋 Adicionar Seção Requisitante":
+def pagina_adicionar_secao_requisitante():
+    """Formulário de cadastro de seção requisitante."""
     st.header("Adicionar Seção Requisitante")
     with st.form("form_secao_requisitante"):
         codigo = st.text_input("Código (ex: SR001)")
@@ -670,22 +880,29 @@ elif opcao == "📋 Adicionar Seção Requisitante":
                     st.error("O campo código não pode estar vazio.")
                 else:
                     data_service.save_secao_requisitante({"codigo": codigo.upper()})
+                    _invalidar_cache()
                     st.success(f"Seção Requisitante {codigo} adicionada com sucesso!")
             except ValueError as e:
                 st.error(str(e))
             except Exception as e:
                 st.error(f"Ocorreu um erro: {e}")
 
-elif opcao == "➕ Adicionar Nota":
+@st.fragment
+def pagina_adicionar_nota():
+    """Formulário de cadastro de nota de crédito."""
     st.header("Adicionar Nota de Crédito")
-    planos = data_service.load_planos_internos()
-    naturezas = data_service.load_naturezas_despesa()
+    planos = _dados_sessao("planos", _load_planos)
+    naturezas = _dados_sessao("naturezas", _load_naturezas)
+    naturezas_por_plano = _dados_sessao("naturezas_por_plano", lambda _: _indexar_naturezas(naturezas))
+    notas = _dados_sessao("notas", _load_notas)
+    notas_por_numero = _dados_sessao("notas_por_numero", lambda _: {n["numero"]: n for n in notas})
     if not planos or not naturezas:
         st.warning("Cadastre pelo menos um Plano Interno e uma Natureza da Despesa antes de adicionar uma nota.")
     else:
+        # Fora do formulário: trocar o plano reexecuta só este fragmento e atualiza as naturezas
+        plano_codigo = st.selectbox("Plano Interno", [p["codigo"] for p in planos])
+        naturezas_filtradas = naturezas_por_plano.get(plano_codigo, [])
         with st.form("form_nota"):
-            plano_codigo = st.selectbox("Plano Interno", [p["codigo"] for p in planos])
-            naturezas_filtradas = [n["codigo"] for n in data_service.load_naturezas_despesa(plano_codigo)]
             natureza_codigo = st.selectbox("Natureza da Despesa", naturezas_filtradas)
             ptres_codigo = st.text_input("PTRES Código (6 dígitos)")
             fonte_codigo = st.text_input("Fonte Código (10 dígitos)")
@@ -697,232 +914,282 @@ elif opcao == "➕ Adicionar Nota":
             submit = st.form_submit_button("Salvar")
             if submit:
                 try:
-                    if not all([plano_codigo, natureza_codigo, ptres_codigo, fonte_codigo, numero, valor, descricao, prazo]):
-                        st.error("Preencha todos os campos obrigatórios.")
-                    elif not validar_ptres(ptres_codigo):
-                        st.error("O PTRES Código deve ter exatamente 6 dígitos.")
-                    elif not validar_fonte(fonte_codigo):
-                        st.error("O Fonte Código deve ter exatamente 10 dígitos.")
-                    elif not validar_nota_numero(numero):
-                        st.error("O Número da Nota deve ser NC seguido de 6 dígitos (ex: NC123456).")
-                    elif not validar_data(prazo):
-                        st.error("Prazo inválido! Use o formato DD/MM/AAAA (ex: 01/08/2025).")
+                    # Tabela de validações em uma única passagem; a nota só é montada se não houver erros
+                    if not all((plano_codigo, natureza_codigo, ptres_codigo, fonte_codigo, numero, valor, descricao, prazo)):
+                        erros = ["Preencha todos os campos obrigatórios."]
                     else:
+                        numero_valido = validar_nota_numero(numero)
                         valor_float = validar_numerico(valor)
-                        if valor_float is None or valor_float <= 0:
-                            st.error("O valor deve ser um número positivo.")
-                        else:
-                            nota = {
-                                "numero": numero.upper(),
-                                "valor": valor_float,
-                                "valor_restante": valor_float,
-                                "descricao": descricao or "Sem descrição",
-                                "observacao": observacao or "Sem observação",
-                                "prazo": prazo,
-                                "data_criacao": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-                                "natureza_despesa_codigo": natureza_codigo,
-                                "plano_interno_codigo": plano_codigo,
-                                "ptres_codigo": ptres_codigo,
-                                "fonte_codigo": fonte_codigo
-                            }
-                            data_service.save_nota(nota)
-                            st.success(f"Nota {numero} adicionada com sucesso!")
+                        validacoes = (
+                            (validar_ptres(ptres_codigo), "O PTRES Código deve ter exatamente 6 dígitos."),
+                            (validar_fonte(fonte_codigo), "O Fonte Código deve ter exatamente 10 dígitos."),
+                            (numero_valido, "O Número da Nota deve ser NC seguido de 6 dígitos (ex: NC123456)."),
+                            # Rejeita duplicatas já conhecidas sem ida ao banco; a restrição de chave primária continua valendo
+                            (not numero_valido or numero.upper() not in notas_por_numero,
+                             f"O número de nota '{numero.upper()}' já existe."),
+                            (validar_data(prazo), "Prazo inválido! Use o formato DD/MM/AAAA (ex: 01/08/2025)."),
+                            (valor_float is not None and valor_float > 0, "O valor deve ser um número positivo."),
+                        )
+                        erros = [mensagem for valido, mensagem in validacoes if not valido]
+                    if erros:
+                        for erro in erros:
+                            st.error(erro)
+                    else:
+                        nota = {
+                            "numero": numero.upper(),
+                            "valor": valor_float,
+                            "valor_restante": valor_float,
+                            "descricao": descricao or "Sem descrição",
+                            "observacao": observacao or "Sem observação",
+                            "prazo": prazo,
+                            "data_criacao": time.strftime("%d/%m/%Y %H:%M:%S"),
+                            "natureza_despesa_codigo": natureza_codigo,
+                            "plano_interno_codigo": plano_codigo,
+                            "ptres_codigo": ptres_codigo,
+                            "fonte_codigo": fonte_codigo
+                        }
+                        data_service.save_nota(nota)
+                        _invalidar_cache()
+                        st.success(f"Nota {numero} adicionada com sucesso!")
                 except ValueError as e:
                     st.error(str(e))
                 except Exception as e:
                     st.error(f"Ocorreu um erro: {e}")
 
-elif opcao == "📉 Registrar Empenho":
+@st.fragment
+def pagina_registrar_empenho():
+    """Formulário de registro de empenho."""
     st.header("Registrar Empenho")
-    notas = data_service.load_notas()
-    secoes = data_service.load_secoes_requisitantes()
+    notas = _dados_sessao("notas", _load_notas)
+    notas_por_numero = _dados_sessao("notas_por_numero", lambda _: {n["numero"]: n for n in notas})
+    notas_rotulos = _dados_sessao("notas_rotulos", lambda _: _rotulos_notas(notas))
+    secoes = _dados_sessao("secoes", _load_secoes)
     if not notas:
         st.warning("Nenhuma nota de crédito cadastrada para registrar um empenho.")
     elif not secoes:
         st.warning("Nenhuma seção requisitante cadastrada. Cadastre uma seção antes de registrar um empenho.")
     else:
         with st.form("form_empenho"):
-            nota_opcoes = [f'{n["numero"]} (Saldo: R${n["valor_restante"]:.2f})' for n in notas]
-            nota_selecionada = st.selectbox("Nota de Crédito", nota_opcoes)
+            numero_nota = st.selectbox("Nota de Crédito", list(notas_rotulos), format_func=notas_rotulos.__getitem__)
             secao_codigo = st.selectbox("Seção Requisitante", [s["codigo"] for s in secoes])
             valor = st.text_input("Valor do Empenho")
             descricao = st.text_input("Descrição")
             submit = st.form_submit_button("Salvar")
             if submit:
                 try:
-                    numero_nota = nota_selecionada.split(" ")[0]
-                    nota = next((n for n in notas if n["numero"] == numero_nota), None)
+                    nota = notas_por_numero[numero_nota]
                     valor_float = validar_numerico(valor)
-                    if not all([numero_nota, secao_codigo, valor, descricao]):
+                    if not all((numero_nota, secao_codigo, valor, descricao)):
                         st.error("Preencha todos os campos.")
                     elif valor_float is None or valor_float <= 0:
                         st.error("O valor do empenho deve ser positivo.")
                     elif valor_float > nota["valor_restante"]:
                         st.error(f"Valor do empenho excede o saldo restante (R${nota['valor_restante']:.2f}).")
                     else:
-                        nota["valor_restante"] -= valor_float
                         empenho = {
                             "numero_nota": numero_nota,
                             "valor": valor_float,
                             "descricao": descricao or "Empenho sem descrição",
-                            "data": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+                            "data": time.strftime("%d/%m/%Y %H:%M:%S"),
                             "secao_requisitante_codigo": secao_codigo
                         }
-                        data_service.save_empenho(empenho, nota)
-                        st.success(f"Empenho de R${valor_float:.2f} registrado na nota {numero_nota}.")
+                        saldo = data_service.save_empenho(empenho)
+                        _invalidar_cache()
+                        st.success(f"Empenho de R${valor_float:.2f} registrado na nota {numero_nota}. Saldo restante: R${saldo:.2f}.")
                 except ValueError as e:
                     st.error(str(e))
                 except Exception as e:
                     st.error(f"Ocorreu um erro: {e}")
 
-elif opcao == "🗑️ Deletar Nota":
+def _descartar_exclusao_pendente(*chaves):
+    """Descarta a confirmação de exclusão pendente, para que ela não sobreviva a outra seleção ou página."""
+    for chave in chaves:
+        st.session_state.pop(chave, None)
+
+def pagina_deletar_nota():
+    """Exclusão de nota de crédito."""
     st.header("Deletar Nota de Crédito")
-    notas = data_service.load_notas()
+    # Mensagem da exclusão feita na execução anterior, antes do st.rerun que atualizou a lista
+    if "mensagem_exclusao" in st.session_state:
+        st.success(st.session_state.pop("mensagem_exclusao"))
+    notas = _dados_sessao("notas", _load_notas)
+    notas_rotulos = _dados_sessao("notas_rotulos", lambda _: _rotulos_notas(notas))
     if not notas:
         st.warning("Nenhuma nota de crédito cadastrada para deletar.")
     else:
-        with st.form("form_deletar_nota"):
-            nota_opcoes = [f'{n["numero"]} (Saldo: R${n["valor_restante"]:.2f})' for n in notas]
-            nota_selecionada = st.selectbox("Nota de Crédito", nota_opcoes)
-            submit = st.form_submit_button("Deletar")
-            if submit:
+        # Fora de formulário: trocar a nota descarta uma confirmação pendente de outra nota
+        numero_nota = st.selectbox("Nota de Crédito", list(notas_rotulos), format_func=notas_rotulos.__getitem__,
+                                   on_change=_descartar_exclusao_pendente, args=("exclusao_pendente_nota",))
+        if st.button("Deletar"):
+            st.session_state["exclusao_pendente_nota"] = numero_nota
+        # Confirmação em segunda etapa: o clique em Confirmar já executa a exclusão
+        numero_pendente = st.session_state.get("exclusao_pendente_nota")
+        if numero_pendente:
+            st.warning(f"Confirma a exclusão da nota {numero_pendente}? Todos os empenhos associados serão excluídos.")
+            confirmar, cancelar = st.columns(2)
+            if confirmar.button("Confirmar exclusão"):
+                del st.session_state["exclusao_pendente_nota"]
                 try:
-                    numero_nota = nota_selecionada.split(" ")[0]
-                    if st.checkbox("Confirmar exclusão (todos os empenhos associados serão excluídos)"):
-                        data_service.delete_nota(numero_nota)
-                        st.success(f"Nota {numero_nota} deletada com sucesso!")
-                    else:
-                        st.warning("Marque a caixa de confirmação para deletar.")
+                    data_service.delete_nota(numero_pendente)
+                    _invalidar_cache()
+                    st.session_state["mensagem_exclusao"] = f"Nota {numero_pendente} deletada com sucesso!"
+                    st.rerun()
                 except ValueError as e:
                     st.error(str(e))
                 except Exception as e:
                     st.error(f"Ocorreu um erro: {e}")
+            elif cancelar.button("Cancelar"):
+                del st.session_state["exclusao_pendente_nota"]
+                st.rerun()
 
-elif opcao == "🗑️ Deletar Empenho":
+def pagina_deletar_empenho():
+    """Exclusão de empenho."""
     st.header("Deletar Empenho")
-    empenhos = data_service.load_empenhos()
+    if "mensagem_exclusao" in st.session_state:
+        st.success(st.session_state.pop("mensagem_exclusao"))
+    empenhos = _dados_sessao("empenhos", _load_empenhos)
+    empenhos_rotulos = _dados_sessao("empenhos_rotulos", lambda _: {
+        e["id"]: f'ID {e["id"]} - Nota {e["numero_nota"]} (Valor: R${e["valor"]:.2f}, Data: {e["data"]}, Seção: {e["secao_requisitante_codigo"]})'
+        for e in empenhos
+    })
     if not empenhos:
         st.warning("Nenhum empenho cadastrado para deletar.")
     else:
-        with st.form("form_deletar_empenho"):
-            empenho_opcoes = [f'ID {e["id"]} - Nota {e["numero_nota"]} (Valor: R${e["valor"]:.2f}, Data: {e["data"]}, Seção: {e["secao_requisitante_codigo"]})' for e in empenhos]
-            empenho_selecionado = st.selectbox("Empenho", empenho_opcoes)
-            submit = st.form_submit_button("Deletar")
-            if submit:
+        empenho_id = st.selectbox("Empenho", list(empenhos_rotulos), format_func=empenhos_rotulos.__getitem__,
+                                  on_change=_descartar_exclusao_pendente, args=("exclusao_pendente_empenho",))
+        if st.button("Deletar"):
+            st.session_state["exclusao_pendente_empenho"] = empenho_id
+        # Confirmação em segunda etapa: o clique em Confirmar já executa a exclusão
+        empenho_pendente = st.session_state.get("exclusao_pendente_empenho")
+        if empenho_pendente is not None:
+            st.warning(f"Confirma a exclusão do empenho ID {empenho_pendente}?")
+            confirmar, cancelar = st.columns(2)
+            if confirmar.button("Confirmar exclusão"):
+                del st.session_state["exclusao_pendente_empenho"]
                 try:
-                    empenho_id = int(empenho_selecionado.split(" ")[1])
-                    if st.checkbox("Confirmar exclusão"):
-                        data_service.delete_empenho(empenho_id)
-                        st.success(f"Empenho ID {empenho_id} deletado com sucesso!")
-                    else:
-                        st.warning("Marque a caixa de confirmação para deletar.")
+                    data_service.delete_empenho(empenho_pendente)
+                    _invalidar_cache()
+                    st.session_state["mensagem_exclusao"] = f"Empenho ID {empenho_pendente} deletado com sucesso!"
+                    st.rerun()
                 except ValueError as e:
                     st.error(str(e))
                 except Exception as e:
                     st.error(f"Ocorreu um erro: {e}")
+            elif cancelar.button("Cancelar"):
+                del st.session_state["exclusao_pendente_empenho"]
+                st.rerun()
 
-elif opcao == "📊 Visualizar Relatório":
+def pagina_visualizar_relatorio():
+    """Relatório detalhado em tabela."""
     st.header("Relatório Detalhado")
-    notas = data_service.load_notas()
-    empenhos = data_service.load_empenhos()
-    naturezas = data_service.load_naturezas_despesa()
-    planos = data_service.load_planos_internos()
-    secoes = data_service.load_secoes_requisitantes()
-
-    data = []
-    for nota in notas:
-        natureza = next((n for n in naturezas if n["codigo"] == nota["natureza_despesa_codigo"]), {"codigo": "N/A", "plano_interno_codigo": None})
-        plano = next((p for p in planos if p["codigo"] == natureza["plano_interno_codigo"]), {"codigo": "N/A"}) if natureza["plano_interno_codigo"] else {"codigo": "N/A"}
-        related_empenhos = [e for e in empenhos if e["numero_nota"] == nota["numero"]]
-        if not related_empenhos:
-            data.append({
-                "Plano Interno": plano["codigo"],
-                "Natureza da Despesa": natureza["codigo"],
-                "PTRES": nota["ptres_codigo"],
-                "Fonte": nota["fonte_codigo"],
-                "Nº Nota": nota["numero"],
-                "V. Original": f"R${nota['valor']:.2f}",
-                "V. Restante": f"R${nota['valor_restante']:.2f}",
-                "Data Empenho": "Nenhum",
-                "V. Empenho": "",
-                "Descrição Empenho": nota["descricao"],
-                "Seção Requisitante": "N/A"
-            })
-        else:
-            for empenho in related_empenhos:
-                secao = next((s for s in secoes if s["codigo"] == empenho["secao_requisitante_codigo"]), {"codigo": "N/A"}) if empenho["secao_requisitante_codigo"] else {"codigo": "N/A"}
-                data.append({
-                    "Plano Interno": plano["codigo"],
-                    "Natureza da Despesa": natureza["codigo"],
-                    "PTRES": nota["ptres_codigo"],
-                    "Fonte": nota["fonte_codigo"],
-                    "Nº Nota": nota["numero"],
-                    "V. Original": f"R${nota['valor']:.2f}",
-                    "V. Restante": f"R${nota['valor_restante']:.2f}",
-                    "Data Empenho": empenho["data"],
-                    "V. Empenho": f"R${empenho['valor']:.2f}",
-                    "Descrição Empenho": empenho["descricao"],
-                    "Seção Requisitante": secao["codigo"]
-                })
-
-    if data:
-        df = pd.DataFrame(data)
-        st.dataframe(df, use_container_width=True)
+    import pandas as pd  # importado sob demanda: só as páginas de relatório usam pandas
+    df = _dados_sessao("relatorio", _load_relatorio)
+
+    if not df.empty:
+        com_empenho = df["empenho_id"].notna()
+        df = pd.DataFrame({
+            "Plano Interno": df["plano"],
+            "Natureza da Despesa": df["natureza"],
+            "PTRES": df["ptres_codigo"],
+            "Fonte": df["fonte_codigo"],
+            "Nº Nota": df["numero"],
+            "V. Original": df["valor"],
+            "V. Restante": df["valor_restante"],
+            "Data Empenho": df["data_empenho"].where(com_empenho, "Nenhum"),
+            "V. Empenho": df["valor_empenho"],
+            "Descrição Empenho": df["descricao_empenho"].where(com_empenho, df["descricao"]),
+            "Seção Requisitante": df["secao"]
+        })
+        # Valores permanecem numéricos; a formatação monetária fica a cargo do frontend
+        st.dataframe(df, use_container_width=True, column_config={
+            coluna: st.column_config.NumberColumn(format="R$%.2f")
+            for coluna in ("V. Original", "V. Restante", "V. Empenho")
+        })
     else:
         st.info("Nenhum dado disponível para exibir.")
 
-elif opcao == "📊 Empenhos por Seção":
+def pagina_empenhos_por_secao():
+    """Empenhos filtrados por seção requisitante."""
     st.header("Empenhos por Seção Requisitante")
-    secoes = data_service.load_secoes_requisitantes()
+    import pandas as pd
+    secoes = _dados_sessao("secoes", _load_secoes)
     if not secoes:
         st.warning("Nenhuma seção requisitante cadastrada.")
     else:
         secao_codigo = st.selectbox("Seção Requisitante", [s["codigo"] for s in secoes])
         if secao_codigo:
-            empenhos = data_service.load_empenhos()
-            data = [
-                {
-                    "Nº Nota": e["numero_nota"],
-                    "Valor Empenho": f"R${e['valor']:.2f}",
-                    "Data Empenho": e["data"],
-                    "Descrição Empenho": e["descricao"]
-                }
-                for e in empenhos if e["secao_requisitante_codigo"] == secao_codigo
-            ]
-            if data:
-                df = pd.DataFrame(data)
-                st.dataframe(df, use_container_width=True)
+            empenhos = _dados_sessao("empenhos", _load_empenhos)
+            df = _dados_sessao("empenhos_df", lambda _: pd.DataFrame(
+                empenhos, columns=["id", "numero_nota", "valor", "descricao", "data", "secao_requisitante_codigo"]
+            ))
+            df = df.loc[df["secao_requisitante_codigo"] == secao_codigo, ["numero_nota", "valor", "data", "descricao"]]
+            if not df.empty:
+                df = df.rename(columns={
+                    "numero_nota": "Nº Nota",
+                    "valor": "Valor Empenho",
+                    "data": "Data Empenho",
+                    "descricao": "Descrição Empenho"
+                }).reset_index(drop=True)
+                st.dataframe(df, use_container_width=True, column_config={
+                    "Valor Empenho": st.column_config.NumberColumn(format="R$%.2f")
+                })
             else:
                 st.info("Nenhum empenho encontrado para esta seção.")
 
-elif opcao == "📑 Relatório Excel":
+def pagina_relatorio_excel():
+    """Geração do relatório em Excel."""
     st.header("Gerar Relatório Excel")
     if st.button("Gerar Relatório"):
         try:
-            filename = data_service.generate_excel_report()
-            with open(filename, "rb") as f:
-                st.download_button(
-                    label="Baixar Relatório Excel",
-                    data=f,
-                    file_name="relatorio_notas_credito.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+            relatorio = _gerar_excel(_versao_dados()["valor"])
+            st.download_button(
+                label="Baixar Relatório Excel",
+                data=relatorio,
+                file_name="relatorio_notas_credito.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
             st.success("Relatório Excel gerado com sucesso!")
         except Exception as e:
             st.error(f"Erro ao gerar relatório: {e}")
 
-elif opcao == "📄 Relatório PDF":
+def pagina_relatorio_pdf():
+    """Geração do relatório em PDF."""
     st.header("Gerar Relatório PDF")
     if st.button("Gerar Relatório"):
         try:
-            filename = data_service.generate_pdf_report()
-            with open(filename, "rb") as f:
-                st.download_button(
-                    label="Baixar Relatório PDF",
-                    data=f,
-                    file_name="relatorio_notas_credito.pdf",
-                    mime="application/pdf"
-                )
+            relatorio = _gerar_pdf(_versao_dados()["valor"])
+            st.download_button(
+                label="Baixar Relatório PDF",
+                data=relatorio,
+                file_name="relatorio_notas_credito.pdf",
+                mime="application/pdf"
+            )
             st.success("Relatório PDF gerado com sucesso!")
         except Exception as e:
-            st.error(f"Erro ao gerar relatório: {e}")
\ No newline at end of file
+            st.error(f"Erro ao gerar relatório: {e}")
+
+# Navegação: cada opção do menu aponta para a função da sua página
+PAGINAS = {
+    "🏠 Início": pagina_inicio,
+    "📋 Adicionar Plano Interno": pagina_adicionar_plano_interno,
+    "📋 Adicionar Natureza da Despesa": pagina_adicionar_natureza_despesa,
+    "📋 Adicionar Seção Requisitante": pagina_adicionar_secao_requisitante,
+    "➕ Adicionar Nota": pagina_adicionar_nota,
+    "📉 Registrar Empenho": pagina_registrar_empenho,
+    "🗑️ Deletar Nota": pagina_deletar_nota,
+    "🗑️ Deletar Empenho": pagina_deletar_empenho,
+    "📊 Visualizar Relatório": pagina_visualizar_relatorio,
+    "📊 Empenhos por Seção": pagina_empenhos_por_secao,
+    "📑 Relatório Excel": pagina_relatorio_excel,
+    "📄 Relatório PDF": pagina_relatorio_pdf
+}
+
+# Barra Lateral de Navegação
+# Trocar de página descarta confirmações de exclusão e mensagens pendentes das páginas de exclusão
+opcao = st.sidebar.selectbox("Menu", list(PAGINAS), on_change=_descartar_exclusao_pendente,
+                             args=("exclusao_pendente_nota", "exclusao_pendente_empenho", "mensagem_exclusao"))
+
+# Estilo Personalizado
+st.markdown(ESTILO_PERSONALIZADO, unsafe_allow_html=True)
+
+PAGINAS[opcao]()
@@ -1,15 +1,27 @@
 import psycopg2
+from psycopg2 import pool
+from psycopg2.errors import CheckViolation
+from psycopg2.extras import execute_batch, execute_values, RealDictCursor
+import io
+import itertools
 import logging
 import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from datetime import datetime
 from dotenv import load_dotenv
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4, landscape
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
+from openpyxl.utils import get_column_letter
 import requests
+from schema import aplicar_esquema
 
 # Configuração do Logging
 LOG_FILE = "erros.log"
@@ -18,8 +30,36 @@ logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format="%(asctime)s -
 # Carregar variáveis de ambiente
 load_dotenv()
 
+# Valores monetários são NUMERIC no banco; os chamadores e os relatórios trabalham com float
+DEC2FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, "DEC2FLOAT",
+    lambda value, cursor: float(value) if value is not None else None
+)
+
+class _ConexaoFloat(psycopg2.extensions.connection):
+    """Conexão do pool que entrega NUMERIC como float, sem alterar o conversor global do psycopg2."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        psycopg2.extensions.register_type(DEC2FLOAT, self)
+
+# Estilos do relatório Excel, criados uma única vez e reaproveitados por todas as células e relatórios
+_HEADER_FONT = Font(bold=True, size=12, color="FFFFFF")
+_HEADER_FILL = PatternFill(start_color="1E90FF", end_color="1E90FF", fill_type="solid")
+_BORDER = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+_ALIGN_CENTER = Alignment(horizontal='center', vertical='center')
+_ALIGN_LEFT = Alignment(horizontal='left', vertical='center', wrap_text=True)
+_BOLD = Font(bold=True)
+# Colunas de texto do relatório Excel, alinhadas à esquerda
+_LEFT_COLS = frozenset({1, 2, 4, 8, 12, 13})
+
+# Validade, em segundos, do cache das tabelas de códigos (planos, naturezas e seções)
+CACHE_TTL = 300
+
 class DataService:
     """Gerencia todas as interações com o banco de dados PostgreSQL e a lógica de negócios."""
+    # Marca que a estrutura do banco já foi verificada neste processo
+    _DB_INITED = False
+
     def __init__(self):
         self.db_params = {
             "dbname": os.getenv("DB_NAME"),
@@ -28,79 +68,85 @@ class DataService:
             "host": os.getenv("DB_HOST"),
             "port": os.getenv("DB_PORT")
         }
+        # Pool criado uma única vez: cada operação reaproveita uma conexão aberta em vez de refazer o handshake.
+        # As conexões devolvidas acima de DB_MINCONN são fechadas, então ele deve acompanhar a concorrência esperada
+        try:
+            self._pool = pool.ThreadedConnectionPool(
+                int(os.getenv("DB_MINCONN", 5)), int(os.getenv("DB_MAXCONN", 10)),
+                connection_factory=_ConexaoFloat, **self.db_params
+            )
+        except psycopg2.Error as e:
+            logging.error(f"Erro ao conectar ao banco de dados: {e}")
+            raise Exception(f"Não foi possível conectar ao banco: {e}")
+        # Cache das tabelas de códigos: bucket -> {chave: (expira_em, linhas)}
+        self._cache = {"planos": {}, "naturezas": {}, "secoes": {}}
+        # Geração de cada bucket, incrementada a cada invalidação
+        self._cache_geracao = {"planos": 0, "naturezas": 0, "secoes": 0}
+        self._cache_lock = threading.Lock()
         self.init_db()
 
+    @contextmanager
     def get_connection(self):
-        """Cria uma conexão com o PostgreSQL."""
+        """Obtém uma conexão do pool, confirma a transação ao final do bloco e a desfaz em caso de erro."""
         try:
-            return psycopg2.connect(**self.db_params)
+            conn = self._pool.getconn()
         except psycopg2.Error as e:
-            logging.error(f"Erro ao conectar ao banco de dados: {e}")
+            logging.error(f"Erro ao obter conexão do pool: {e}")
             raise Exception(f"Não foi possível conectar ao banco: {e}")
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._pool.putconn(conn)
+
+    def _cached(self, bucket, chave, carregar):
+        """Retorna as linhas em cache do bucket/chave, recarregando-as do banco se ausentes ou expiradas."""
+        agora = time.monotonic()
+        with self._cache_lock:
+            entrada = self._cache[bucket].get(chave)
+            if entrada and entrada[0] > agora:
+                return [dict(linha) for linha in entrada[1]]
+            geracao = self._cache_geracao[bucket]
+        linhas = tuple(carregar())
+        with self._cache_lock:
+            # Uma escrita invalidou o bucket durante a leitura: as linhas lidas podem estar desatualizadas
+            if self._cache_geracao[bucket] == geracao:
+                self._cache[bucket][chave] = (agora + CACHE_TTL, linhas)
+        # Cópias: alterações feitas pelo chamador não chegam ao cache
+        return [dict(linha) for linha in linhas]
+
+    def _invalidar_cache(self, *buckets):
+        """Descarta o cache dos buckets informados após uma escrita."""
+        with self._cache_lock:
+            for bucket in buckets:
+                self._cache[bucket].clear()
+                self._cache_geracao[bucket] += 1
+
+    def close(self):
+        """Fecha todas as conexões do pool."""
+        self._pool.closeall()
 
     def init_db(self):
         """Inicializa o banco de dados PostgreSQL com a estrutura necessária."""
+        if DataService._DB_INITED:
+            return
         try:
             with self.get_connection() as conn:
-                with conn.cursor() as c:
-                    # Criar tabelas, se não existirem
-                    c.execute('''
-                        CREATE TABLE IF NOT EXISTS planos_internos (
-                            codigo TEXT PRIMARY KEY
-                        );
-                    ''')
-                    c.execute('''
-                        CREATE TABLE IF NOT EXISTS naturezas_despesa (
-                            codigo TEXT PRIMARY KEY,
-                            plano_interno_codigo TEXT,
-                            FOREIGN KEY (plano_interno_codigo) REFERENCES planos_internos (codigo) ON DELETE CASCADE
-                        );
-                    ''')
-                    c.execute('''
-                        CREATE TABLE IF NOT EXISTS secoes_requisitantes (
-                            codigo TEXT PRIMARY KEY
-                        );
-                    ''')
-                    c.execute('''
-                        CREATE TABLE IF NOT EXISTS notas (
-                            numero TEXT PRIMARY KEY,
-                            valor REAL,
-                            valor_restante REAL,
-                            descricao TEXT,
-                            observacao TEXT,
-                            prazo TEXT,
-                            data_criacao TEXT,
-                            natureza_despesa_codigo TEXT,
-                            plano_interno_codigo TEXT,
-                            ptres_codigo TEXT,
-                            fonte_codigo TEXT,
-                            FOREIGN KEY (natureza_despesa_codigo) REFERENCES naturezas_despesa (codigo) ON DELETE CASCADE,
-                            FOREIGN KEY (plano_interno_codigo) REFERENCES planos_internos (codigo) ON DELETE CASCADE
-                        );
-                    ''')
-                    c.execute('''
-                        CREATE TABLE IF NOT EXISTS empenhos (
-                            id SERIAL PRIMARY KEY,
-                            numero_nota TEXT,
-                            valor REAL,
-                            descricao TEXT,
-                            data TEXT,
-                            secao_requisitante_codigo TEXT,
-                            FOREIGN KEY (numero_nota) REFERENCES notas (numero) ON DELETE CASCADE,
-                            FOREIGN KEY (secao_requisitante_codigo) REFERENCES secoes_requisitantes (codigo) ON DELETE SET NULL
-                        );
-                    ''')
-                    conn.commit()
+                if aplicar_esquema(conn):
                     logging.info("Banco de dados inicializado com sucesso.")
+            DataService._DB_INITED = True
         except Exception as e:
             logging.error(f"Erro ao inicializar banco de dados: {e}")
             raise Exception(f"Não foi possível inicializar o banco: {e}")
 
     def load_data(self, query, params=None):
-        """Carrega dados do banco de dados com segurança."""
+        """Carrega dados do banco de dados com segurança, com cada linha como dicionário indexado pelas colunas."""
         try:
             with self.get_connection() as conn:
-                with conn.cursor() as c:
+                with conn.cursor(cursor_factory=RealDictCursor) as c:
                     if params:
                         c.execute(query, params)
                     else:
@@ -110,10 +156,35 @@ class DataService:
             logging.error(f"Erro ao carregar dados ({query}): {e}")
             raise Exception(f"Não foi possível ler os dados: {e}")
 
+    def iter_data(self, query, params=None, itersize=2000, totais_query=None):
+        """Percorre o resultado de uma consulta em lotes por meio de um cursor no servidor.
+
+        Com totais_query, a linha de totais (em Decimal) é produzida antes das linhas, lida no mesmo snapshot."""
+        try:
+            with self.get_connection() as conn:
+                if totais_query:
+                    with conn.cursor() as c:
+                        # Somas exatas: neste cursor o NUMERIC volta a ser Decimal, em vez do float da conexão
+                        psycopg2.extensions.register_type(psycopg2.extensions.DECIMAL, c)
+                        # Isolamento e totais seguem juntos, em uma única ida ao servidor; o SET TRANSACTION é o
+                        # primeiro comando da transação, então totais e linhas enxergam o mesmo snapshot
+                        c.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY;" + totais_query)
+                        totais = c.fetchone()
+                    yield totais
+                # Cursor nomeado: o servidor entrega as linhas em blocos de itersize em vez de todas de uma vez
+                with conn.cursor(name=f"s_{uuid.uuid4().hex}") as c:
+                    c.itersize = itersize
+                    c.execute(query, params)
+                    yield from c
+        except Exception as e:
+            logging.error(f"Erro ao carregar dados ({query}): {e}")
+            raise Exception(f"Não foi possível ler os dados: {e}")
+
     def load_planos_internos(self):
         """Carrega todos os planos internos."""
-        rows = self.load_data("SELECT codigo FROM planos_internos ORDER BY codigo")
-        return [{"codigo": r[0]} for r in rows]
+        return self._cached("planos", None, lambda: self.load_data(
+            "SELECT codigo FROM planos_internos ORDER BY codigo"
+        ))
 
     def load_naturezas_despesa(self, plano_interno_codigo=None):
         """Carrega naturezas de despesa, opcionalmente filtrando por plano interno."""
@@ -122,13 +193,13 @@ class DataService:
         if plano_interno_codigo:
             query += " WHERE plano_interno_codigo = %s"
             params = (plano_interno_codigo,)
-        rows = self.load_data(query, params)
-        return [{"codigo": r[0], "plano_interno_codigo": r[1]} for r in rows]
+        return self._cached("naturezas", plano_interno_codigo or None, lambda: self.load_data(query, params))
 
     def load_secoes_requisitantes(self):
         """Carrega todas as seções requisitantes."""
-        rows = self.load_data("SELECT codigo FROM secoes_requisitantes ORDER BY codigo")
-        return [{"codigo": r[0]} for r in rows]
+        return self._cached("secoes", None, lambda: self.load_data(
+            "SELECT codigo FROM secoes_requisitantes ORDER BY codigo"
+        ))
 
     def load_notas(self, natureza_despesa_codigo=None):
         """Carrega todas as notas, opcionalmente filtrando por natureza da despesa."""
@@ -137,13 +208,7 @@ class DataService:
         if natureza_despesa_codigo:
             query = query.replace("ORDER BY", "WHERE natureza_despesa_codigo = %s ORDER BY")
             params = (natureza_despesa_codigo,)
-        rows = self.load_data(query, params)
-        return [{
-            "numero": r[0], "valor": r[1], "valor_restante": r[2], "descricao": r[3],
-            "observacao": r[4], "prazo": r[5], "data_criacao": r[6],
-            "natureza_despesa_codigo": r[7], "plano_interno_codigo": r[8],
-            "ptres_codigo": r[9], "fonte_codigo": r[10]
-        } for r in rows]
+        return self.load_data(query, params)
 
     def load_empenhos(self, numero_nota=None):
         """Carrega empenhos, opcionalmente filtrando por número de nota."""
@@ -152,11 +217,28 @@ class DataService:
         if numero_nota:
             query += " WHERE numero_nota = %s"
             params = (numero_nota,)
-        rows = self.load_data(query, params)
-        return [{
-            "id": r[0], "numero_nota": r[1], "valor": r[2], "descricao": r[3],
-            "data": r[4], "secao_requisitante_codigo": r[5]
-        } for r in rows]
+        return self.load_data(query, params)
+
+    def _load_report(self):
+        """Retorna os totais gerais, somados no servidor, e as linhas dos relatórios (uma por empenho, ou uma por
+        nota sem empenhos), lidas no mesmo snapshot."""
+        linhas = self.iter_data("""
+            SELECT COALESCE(pi.codigo, 'N/A'), COALESCE(nd.codigo, 'N/A'), n.ptres_codigo, n.fonte_codigo,
+                   n.numero, n.valor, n.valor_restante, n.descricao, n.prazo,
+                   e.id, e.data, e.valor, e.descricao, COALESCE(s.codigo, 'N/A')
+            FROM notas n
+            LEFT JOIN naturezas_despesa nd ON nd.codigo = n.natureza_despesa_codigo
+            LEFT JOIN planos_internos pi ON pi.codigo = n.plano_interno_codigo
+            LEFT JOIN empenhos e ON e.numero_nota = n.numero
+            LEFT JOIN secoes_requisitantes s ON s.codigo = e.secao_requisitante_codigo
+            ORDER BY n.data_criacao DESC, n.numero, e.id
+        """, totais_query="""
+            SELECT COALESCE(SUM(valor), 0), COALESCE(SUM(valor_restante), 0),
+                   (SELECT COALESCE(SUM(valor), 0) FROM empenhos WHERE numero_nota IS NOT NULL)
+            FROM notas
+        """)
+        # A primeira linha produzida são os totais; as demais seguem em fluxo pela mesma conexão
+        return next(linhas), linhas
 
     def save_plano_interno(self, plano_interno):
         """Salva um novo plano interno."""
@@ -165,7 +247,7 @@ class DataService:
                 with conn.cursor() as c:
                     c.execute("INSERT INTO planos_internos (codigo) VALUES (%s)",
                               (plano_interno["codigo"],))
-                    conn.commit()
+            self._invalidar_cache("planos")
             logging.info(f"Plano Interno {plano_interno['codigo']} salvo com sucesso.")
         except psycopg2.IntegrityError:
             logging.error(f"Erro de integridade ao salvar plano interno: {plano_interno['codigo']} já existe.")
@@ -181,7 +263,7 @@ class DataService:
                 with conn.cursor() as c:
                     c.execute("INSERT INTO naturezas_despesa (codigo, plano_interno_codigo) VALUES (%s, %s)",
                               (natureza_despesa["codigo"], natureza_despesa["plano_interno_codigo"]))
-                    conn.commit()
+            self._invalidar_cache("naturezas")
             logging.info(f"Natureza da Despesa {natureza_despesa['codigo']} salva com sucesso.")
         except psycopg2.IntegrityError:
             logging.error(f"Erro de integridade ao salvar natureza da despesa: {natureza_despesa['codigo']} já existe.")
@@ -197,7 +279,7 @@ class DataService:
                 with conn.cursor() as c:
                     c.execute("INSERT INTO secoes_requisitantes (codigo) VALUES (%s)",
                               (secao_requisitante["codigo"],))
-                    conn.commit()
+            self._invalidar_cache("secoes")
             logging.info(f"Seção Requisitante {secao_requisitante['codigo']} salva com sucesso.")
         except psycopg2.IntegrityError:
             logging.error(f"Erro de integridade ao salvar seção requisitante: {secao_requisitante['codigo']} já existe.")
@@ -221,7 +303,6 @@ class DataService:
                         nota["natureza_despesa_codigo"], nota["plano_interno_codigo"],
                         nota["ptres_codigo"], nota["fonte_codigo"]
                     ))
-                    conn.commit()
             logging.info(f"Nota {nota['numero']} salva com sucesso.")
         except psycopg2.IntegrityError:
             logging.error(f"Erro de integridade ao salvar nota: {nota['numero']} já existe.")
@@ -230,8 +311,8 @@ class DataService:
             logging.error(f"Erro ao salvar nota: {e}")
             raise
 
-    def save_empenho(self, empenho, nota):
-        """Salva um empenho e atualiza o valor restante da nota."""
+    def save_empenho(self, empenho):
+        """Salva um empenho; o trigger da tabela desconta seu valor do saldo da nota."""
         try:
             with self.get_connection() as conn:
                 with conn.cursor() as c:
@@ -242,21 +323,68 @@ class DataService:
                         empenho["numero_nota"], empenho["valor"], empenho["descricao"],
                         empenho["data"], empenho["secao_requisitante_codigo"]
                     ))
-                    c.execute("UPDATE notas SET valor_restante = %s WHERE numero = %s",
-                              (nota["valor_restante"], nota["numero"]))
-                    conn.commit()
             logging.info(f"Empenho de R${empenho['valor']:.2f} registrado para nota {empenho['numero_nota']}.")
+        except CheckViolation:
+            logging.error(f"Empenho de R${empenho['valor']:.2f} excede o saldo da nota {empenho['numero_nota']}.")
+            raise ValueError("Valor do empenho excede o saldo restante da nota.")
         except Exception as e:
             logging.error(f"Erro ao salvar empenho: {e}")
             raise
 
+    def save_notas_bulk(self, notas):
+        """Salva várias notas em um único INSERT multi-VALUES e uma única transação."""
+        # Lista montada antes da ida ao banco: aceita geradores e dá a contagem para o log
+        linhas = [(
+            n["numero"], n["valor"], n["valor_restante"], n["descricao"],
+            n["observacao"], n["prazo"], n["data_criacao"],
+            n["natureza_despesa_codigo"], n["plano_interno_codigo"],
+            n["ptres_codigo"], n["fonte_codigo"]
+        ) for n in notas]
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as c:
+                    execute_values(c, """
+                        INSERT INTO notas (numero, valor, valor_restante, descricao, observacao, prazo, data_criacao,
+                                           natureza_despesa_codigo, plano_interno_codigo, ptres_codigo, fonte_codigo)
+                        VALUES %s
+                    """, linhas, page_size=500)
+            logging.info(f"{len(linhas)} notas salvas em lote com sucesso.")
+        except psycopg2.IntegrityError as e:
+            logging.error(f"Erro de integridade ao salvar notas em lote: {e}")
+            raise ValueError(f"Não foi possível salvar as notas: {e}")
+        except Exception as e:
+            logging.error(f"Erro ao salvar notas em lote: {e}")
+            raise
+
+    def save_empenhos_bulk(self, empenhos):
+        """Salva vários empenhos em uma única transação; o trigger da tabela abate os valores das notas."""
+        linhas = [(
+            e["numero_nota"], e["valor"], e["descricao"],
+            e["data"], e["secao_requisitante_codigo"]
+        ) for e in empenhos]
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as c:
+                    execute_values(c, """
+                        INSERT INTO empenhos (numero_nota, valor, descricao, data, secao_requisitante_codigo)
+                        VALUES %s
+                    """, linhas, page_size=500)
+            logging.info(f"{len(linhas)} empenhos registrados em lote com sucesso.")
+        except CheckViolation:
+            logging.error("Empenhos em lote excedem o saldo de ao menos uma nota.")
+            raise ValueError("Valor dos empenhos excede o saldo restante de ao menos uma nota.")
+        except Exception as e:
+            logging.error(f"Erro ao salvar empenhos em lote: {e}")
+            raise
+
     def delete_plano_interno(self, codigo):
         """Deleta um plano interno."""
         try:
             with self.get_connection() as conn:
                 with conn.cursor() as c:
                     c.execute("DELETE FROM planos_internos WHERE codigo = %s", (codigo,))
-                    conn.commit()
+            # A exclusão remove em cascata as naturezas do plano
+            self._invalidar_cache("planos", "naturezas")
             logging.info(f"Plano Interno {codigo} deletado com sucesso.")
         except Exception as e:
             logging.error(f"Erro ao deletar plano interno {codigo}: {e}")
@@ -268,7 +396,7 @@ class DataService:
             with self.get_connection() as conn:
                 with conn.cursor() as c:
                     c.execute("DELETE FROM naturezas_despesa WHERE codigo = %s", (codigo,))
-                    conn.commit()
+            self._invalidar_cache("naturezas")
             logging.info(f"Natureza da Despesa {codigo} deletada com sucesso.")
         except Exception as e:
             logging.error(f"Erro ao deletar natureza da despesa {codigo}: {e}")
@@ -280,7 +408,7 @@ class DataService:
             with self.get_connection() as conn:
                 with conn.cursor() as c:
                     c.execute("DELETE FROM secoes_requisitantes WHERE codigo = %s", (codigo,))
-                    conn.commit()
+            self._invalidar_cache("secoes")
             logging.info(f"Seção Requisitante {codigo} deletada com sucesso.")
         except Exception as e:
             logging.error(f"Erro ao deletar seção requisitante {codigo}: {e}")
@@ -292,137 +420,166 @@ class DataService:
             with self.get_connection() as conn:
                 with conn.cursor() as c:
                     c.execute("DELETE FROM notas WHERE numero = %s", (numero_nota,))
-                    conn.commit()
             logging.info(f"Nota {numero_nota} deletada com sucesso.")
         except Exception as e:
             logging.error(f"Erro ao deletar nota {numero_nota}: {e}")
             raise
 
     def delete_empenho(self, empenho_id):
-        """Deleta um empenho e atualiza o valor restante da nota associada."""
+        """Deleta um empenho; o trigger da tabela devolve seu valor ao saldo da nota."""
         try:
             with self.get_connection() as conn:
                 with conn.cursor() as c:
-                    c.execute("SELECT numero_nota, valor FROM empenhos WHERE id = %s", (empenho_id,))
-                    empenho = c.fetchone()
-                    if not empenho:
-                        raise ValueError("Empenho não encontrado.")
-                    numero_nota, valor_empenho = empenho
-                    c.execute("UPDATE notas SET valor_restante = valor_restante + %s WHERE numero = %s",
-                              (valor_empenho, numero_nota))
                     c.execute("DELETE FROM empenhos WHERE id = %s", (empenho_id,))
-                    conn.commit()
+                    if c.rowcount == 0:
+                        raise ValueError("Empenho não encontrado.")
             logging.info(f"Empenho {empenho_id} deletado com sucesso.")
         except Exception as e:
             logging.error(f"Erro ao deletar empenho {empenho_id}: {e}")
             raise
 
+    def _delete_bulk(self, tabela, coluna, chaves):
+        """Deleta várias linhas de uma tabela pela chave, agrupando os comandos em poucas idas ao banco."""
+        linhas = [(chave,) for chave in chaves]
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as c:
+                    execute_batch(c, f"DELETE FROM {tabela} WHERE {coluna} = %s", linhas, page_size=200)
+            logging.info(f"{len(linhas)} registros deletados em lote de {tabela} com sucesso.")
+        except Exception as e:
+            logging.error(f"Erro ao deletar em lote de {tabela}: {e}")
+            raise
+
+    def delete_planos_internos_bulk(self, codigos):
+        """Deleta vários planos internos em uma única transação."""
+        self._delete_bulk("planos_internos", "codigo", codigos)
+        # A exclusão remove em cascata as naturezas dos planos
+        self._invalidar_cache("planos", "naturezas")
+
+    def delete_naturezas_despesa_bulk(self, codigos):
+        """Deleta várias naturezas da despesa em uma única transação."""
+        self._delete_bulk("naturezas_despesa", "codigo", codigos)
+        self._invalidar_cache("naturezas")
+
+    def delete_secoes_requisitantes_bulk(self, codigos):
+        """Deleta várias seções requisitantes em uma única transação."""
+        self._delete_bulk("secoes_requisitantes", "codigo", codigos)
+        self._invalidar_cache("secoes")
+
+    def delete_notas_bulk(self, numeros):
+        """Deleta várias notas em uma única transação."""
+        self._delete_bulk("notas", "numero", numeros)
+
+    def delete_empenhos_bulk(self, empenho_ids):
+        """Deleta vários empenhos em uma única transação; o trigger devolve os valores aos saldos das notas."""
+        self._delete_bulk("empenhos", "id", empenho_ids)
+
     def generate_excel_report(self):
         """Gera relatório em Excel com uma linha por empenho, incluindo a hierarquia."""
-        notas = self.load_notas()
-        empenhos = self.load_empenhos()
-        naturezas = self.load_naturezas_despesa()
-        planos = self.load_planos_internos()
-        secoes = self.load_secoes_requisitantes()
-
-        total_valor_geral = sum(n["valor"] for n in notas)
-        total_restante_geral = sum(n["valor_restante"] for n in notas)
-        total_empenhado_geral = sum(e["valor"] for e in empenhos)
-
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Relatório Detalhado de Empenhos"
-
-        header_font = Font(bold=True, size=12, color="FFFFFF")
-        header_fill = PatternFill(start_color="1E90FF", end_color="1E90FF", fill_type="solid")
-        border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-        align_center = Alignment(horizontal='center', vertical='center')
-        align_left = Alignment(horizontal='left', vertical='center', wrap_text=True)
+        totais, report_rows = self._load_report()
+        return self._salvar_relatorio("relatorios/relatorio_notas_credito.xlsx", self._write_excel(report_rows, totais))
+
+    def generate_pdf_report(self):
+        """Gera relatório em PDF com uma linha por empenho, incluindo a hierarquia."""
+        totais, report_rows = self._load_report()
+        return self._salvar_relatorio("relatorios/relatorio_notas_credito.pdf", self._write_pdf(report_rows, totais))
+
+    def generate_all_reports(self):
+        """Gera os relatórios Excel e PDF a partir de uma única leitura do banco e retorna seus bytes."""
+        totais, report_rows = self._load_report()
+        # Um gerador após o outro: o tee guarda para o PDF as linhas já entregues ao Excel, e o PDF
+        # mantém todas as linhas em memória para o layout de qualquer forma
+        linhas_excel, linhas_pdf = itertools.tee(report_rows)
+        return self._write_excel(linhas_excel, totais), self._write_pdf(linhas_pdf, totais)
+
+    def _salvar_relatorio(self, filename, dados):
+        """Grava os bytes de um relatório por meio de um arquivo temporário e retorna o caminho."""
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # os.replace é atômico: gerações simultâneas nunca deixam um arquivo misturado ou pela metade
+        temporario = f"{filename}.{uuid.uuid4().hex}.tmp"
+        with open(temporario, "wb") as f:
+            f.write(dados)
+        os.replace(temporario, filename)
+        return filename
+
+    def _write_excel(self, report_rows, totais):
+        """Monta o relatório Excel a partir das linhas e dos totais gerais do relatório e retorna seus bytes."""
+        # Modo write-only: as células são estilizadas ao serem escritas e descartadas após o flush
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("Relatório Detalhado de Empenhos")
 
         headers = [
             "Plano Interno", "Natureza da Despesa", "PTRES", "Fonte",
             "Nº Nota", "Valor Original (R$)", "Valor Restante (R$)", "Descrição da Nota", "Prazo",
             "Data Empenho", "Valor Empenho (R$)", "Descrição Empenho", "Seção Requisitante"
         ]
-        ws.append(headers)
-
-        for cell in ws[1]:
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = align_center
-            cell.border = border
 
-        for nota in notas:
-            natureza = next((n for n in naturezas if n["codigo"] == nota["natureza_despesa_codigo"]), {"codigo": "N/A", "plano_interno_codigo": None})
-            plano = next((p for p in planos if p["codigo"] == natureza["plano_interno_codigo"]), {"codigo": "N/A"}) if natureza["plano_interno_codigo"] else {"codigo": "N/A"}
-
-            related_empenhos = [e for e in empenhos if e["numero_nota"] == nota["numero"]]
-            if not related_empenhos:
+        # O modo write-only exige as larguras antes da primeira linha; com as linhas lidas em fluxo,
+        # elas são fixas em vez de calculadas a partir do conteúdo
+        col_widths = [18, 25, 10, 14, 12, 22, 22, 40, 12, 22, 20, 40, 22]
+        for i, width in enumerate(col_widths, start=1):
+            ws.column_dimensions[get_column_letter(i)].width = width
+
+        header_cells = []
+        for value in headers:
+            cell = WriteOnlyCell(ws, value=value)
+            cell.font = _HEADER_FONT
+            cell.fill = _HEADER_FILL
+            cell.alignment = _ALIGN_CENTER
+            cell.border = _BORDER
+            header_cells.append(cell)
+        ws.append(header_cells)
+
+        for (plano, natureza, ptres, fonte, numero, valor, valor_restante, descricao, prazo,
+             empenho_id, empenho_data, empenho_valor, empenho_descricao, secao) in report_rows:
+            if empenho_id is None:
                 row_data = [
-                    plano["codigo"], natureza["codigo"], nota["ptres_codigo"], nota["fonte_codigo"],
-                    nota["numero"], nota["valor"], nota["valor_restante"], nota["descricao"], nota["prazo"],
+                    plano, natureza, ptres, fonte, numero, valor, valor_restante, descricao, prazo,
                     "Nenhum empenho", "", "", "N/A"
                 ]
-                ws.append(row_data)
             else:
-                for empenho in related_empenhos:
-                    secao = next((s for s in secoes if s["codigo"] == empenho["secao_requisitante_codigo"]), {"codigo": "N/A"}) if empenho["secao_requisitante_codigo"] else {"codigo": "N/A"}
-                    row_data = [
-                        plano["codigo"], natureza["codigo"], nota["ptres_codigo"], nota["fonte_codigo"],
-                        nota["numero"], nota["valor"], nota["valor_restante"], nota["descricao"], nota["prazo"],
-                        empenho["data"], empenho["valor"], empenho["descricao"], secao["codigo"]
-                    ]
-                    ws.append(row_data)
-
-        for row in ws.iter_rows(min_row=2, max_row=ws.max_row):
-            for cell in row:
-                cell.border = border
-                cell.alignment = align_left if cell.column in [1, 2, 4, 8, 12, 13] else align_center
+                row_data = [
+                    plano, natureza, ptres, fonte, numero, valor, valor_restante, descricao, prazo,
+                    empenho_data, empenho_valor, empenho_descricao, secao
+                ]
+            cells = []
+            for col, value in enumerate(row_data, start=1):
+                cell = WriteOnlyCell(ws, value=value)
+                cell.border = _BORDER
+                cell.alignment = _ALIGN_LEFT if col in _LEFT_COLS else _ALIGN_CENTER
+                cells.append(cell)
+            ws.append(cells)
+
+        total_valor_geral, total_restante_geral, total_empenhado_geral = totais
+        totals_row = [None] * len(headers)
+        totals_row[0] = "TOTAIS GERAIS"
+        totals_row[5] = total_valor_geral
+        totals_row[6] = total_restante_geral
+        totals_row[10] = total_empenhado_geral
 
         ws.append([])  # Linha em branco
-        total_row_idx = ws.max_row + 1
-        ws.cell(row=total_row_idx, column=1, value="TOTAIS GERAIS").font = header_font
-        ws.cell(row=total_row_idx, column=6, value=total_valor_geral).font = Font(bold=True)
-        ws.cell(row=total_row_idx, column=7, value=total_restante_geral).font = Font(bold=True)
-        ws.cell(row=total_row_idx, column=11, value=total_empenhado_geral).font = Font(bold=True)
-
-        for col in range(1, len(headers) + 1):
-            ws.cell(row=total_row_idx, column=col).border = border
-            ws.cell(row=total_row_idx, column=col).alignment = align_center
-        ws.cell(row=total_row_idx, column=1).fill = header_fill
-
-        for col in ws.columns:
-            max_length = 0
-            for cell in col:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = (max_length + 2) * 1.2
-            ws.column_dimensions[col[0].column_letter].width = min(adjusted_width, 50)
-
-        filename = "relatorios/relatorio_notas_credito.xlsx"
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        wb.save(filename)
+        total_cells = []
+        for col, value in enumerate(totals_row, start=1):
+            cell = WriteOnlyCell(ws, value=value)
+            cell.border = _BORDER
+            cell.alignment = _ALIGN_CENTER
+            if col == 1:
+                cell.font = _HEADER_FONT
+                cell.fill = _HEADER_FILL
+            elif value is not None:
+                cell.font = _BOLD
+            total_cells.append(cell)
+        ws.append(total_cells)
+
+        buffer = io.BytesIO()
+        wb.save(buffer)
         logging.info("Relatório Excel gerado com sucesso.")
-        return filename
-
-    def generate_pdf_report(self):
-        """Gera relatório em PDF com uma linha por empenho, incluindo a hierarquia."""
-        notas = self.load_notas()
-        empenhos = self.load_empenhos()
-        naturezas = self.load_naturezas_despesa()
-        planos = self.load_planos_internos()
-        secoes = self.load_secoes_requisitantes()
-
-        total_valor_geral = sum(n["valor"] for n in notas)
-        total_restante_geral = sum(n["valor_restante"] for n in notas)
-        total_empenhado_geral = sum(e["valor"] for e in empenhos)
+        return buffer.getvalue()
 
-        filename = "relatorios/relatorio_notas_credito.pdf"
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        doc = SimpleDocTemplate(filename, pagesize=landscape(A4))
+    def _write_pdf(self, report_rows, totais):
+        """Monta o relatório PDF a partir das linhas e dos totais gerais do relatório e retorna seus bytes."""
+        buffer = io.BytesIO()
+        doc = SimpleDocTemplate(buffer, pagesize=landscape(A4))
         styles = getSampleStyleSheet()
         elements = []
 
@@ -430,51 +587,64 @@ class DataService:
             "Plano Interno", "Natureza da Despesa", "PTRES", "Fonte",
             "Nº Nota", "V. Original", "V. Restante", "Data Empenho", "V. Empenho", "Descrição Empenho", "Seção Requisitante"
         ]
-        data = [headers]
-
-        for nota in notas:
-            natureza = next((n for n in naturezas if n["codigo"] == nota["natureza_despesa_codigo"]), {"codigo": "N/A", "plano_interno_codigo": None})
-            plano = next((p for p in planos if p["codigo"] == natureza["plano_interno_codigo"]), {"codigo": "N/A"}) if natureza["plano_interno_codigo"] else {"codigo": "N/A"}
-
-            related_empenhos = [e for e in empenhos if e["numero_nota"] == nota["numero"]]
-            if not related_empenhos:
+        data = []
+        body_style = styles['BodyText']
+
+        # Códigos, datas e valores são curtos e vão como texto simples; só as descrições passam
+        # pelo Paragraph, que quebra linhas mas tem custo de layout por célula
+        for (plano, natureza, ptres, fonte, numero, valor, valor_restante, descricao, prazo,
+             empenho_id, empenho_data, empenho_valor, empenho_descricao, secao) in report_rows:
+            if empenho_id is None:
                 data.append([
-                    Paragraph(plano["codigo"], styles['BodyText']),
-                    Paragraph(natureza["codigo"], styles['BodyText']),
-                    Paragraph(nota["ptres_codigo"], styles['BodyText']),
-                    Paragraph(nota["fonte_codigo"], styles['BodyText']),
-                    Paragraph(nota["numero"], styles['BodyText']),
-                    f"R$ {nota['valor']:.2f}", f"R$ {nota['valor_restante']:.2f}",
-                    "Nenhum", "", Paragraph(nota["descricao"], styles['BodyText']), "N/A"
+                    plano, natureza, ptres, fonte, numero,
+                    f"R$ {valor:.2f}", f"R$ {valor_restante:.2f}",
+                    "Nenhum", "", Paragraph(descricao, body_style), "N/A"
                 ])
             else:
-                for empenho in related_empenhos:
-                    secao = next((s for s in secoes if s["codigo"] == empenho["secao_requisitante_codigo"]), {"codigo": "N/A"}) if empenho["secao_requisitante_codigo"] else {"codigo": "N/A"}
-                    data.append([
-                        Paragraph(plano["codigo"], styles['BodyText']),
-                        Paragraph(natureza["codigo"], styles['BodyText']),
-                        Paragraph(nota["ptres_codigo"], styles['BodyText']),
-                        Paragraph(nota["fonte_codigo"], styles['BodyText']),
-                        Paragraph(nota["numero"], styles['BodyText']),
-                        f"R$ {nota['valor']:.2f}", f"R$ {nota['valor_restante']:.2f}",
-                        empenho["data"], f"R$ {empenho['valor']:.2f}", Paragraph(empenho["descricao"], styles['BodyText']),
-                        Paragraph(secao["codigo"], styles['BodyText'])
-                    ])
-
-        table = Table(data, colWidths=[80, 80, 80, 80, 80, 80, 80, 100, 80, 180, 80])
-        table.setStyle(TableStyle([
+                data.append([
+                    plano, natureza, ptres, fonte, numero,
+                    f"R$ {valor:.2f}", f"R$ {valor_restante:.2f}",
+                    empenho_data, f"R$ {empenho_valor:.2f}", Paragraph(empenho_descricao, body_style), secao
+                ])
+        total_valor_geral, total_restante_geral, total_empenhado_geral = totais
+
+        title = Paragraph("Relatório Detalhado de Notas de Crédito e Empenhos", styles['h1'])
+        elements.append(title)
+
+        # Tabelas em blocos de uma página: uma tabela única é repartida a cada quebra de página,
+        # o que torna o layout quadrático no número de linhas. Larguras e estilo são montados uma só vez
+        # e compartilhados por todos os blocos
+        col_widths = [80, 80, 80, 80, 80, 80, 80, 100, 80, 180, 80]
+        table_style = TableStyle([
             ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#1E90FF")),
             ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
             ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
             ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
             ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
             ('GRID', (0, 0), (-1, -1), 1, colors.black),
             ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ]))
-
-        title = Paragraph("Relatório Detalhado de Notas de Crédito e Empenhos", styles['h1'])
-        elements.append(title)
-        elements.append(table)
+        ])
+
+        def altura(linhas):
+            return Table(linhas, colWidths=col_widths, style=table_style).wrap(doc.width, doc.height)[1]
+
+        # O tamanho de cada bloco vem da altura útil da página (descontado o padding do frame) e da altura
+        # medida de cada linha, que varia com a quebra das descrições; cada bloco seguinte começa em nova página
+        altura_pagina = doc.height - 12
+        altura_cabecalho = altura([headers])
+        espaco = altura_pagina - title.wrap(doc.width, doc.height)[1] - title.getSpaceAfter()
+        bloco, ocupado = [headers], altura_cabecalho
+        for linha in data:
+            altura_linha = altura([linha])
+            if len(bloco) > 1 and ocupado + altura_linha > espaco:
+                # repeatRows: uma linha mais alta que a página ainda é repartida com o cabeçalho repetido
+                elements.append(Table(bloco, colWidths=col_widths, style=table_style, repeatRows=1))
+                elements.append(PageBreak())
+                bloco, ocupado, espaco = [headers], altura_cabecalho, altura_pagina
+            bloco.append(linha)
+            ocupado += altura_linha
+        elements.append(Table(bloco, colWidths=col_widths, style=table_style, repeatRows=1))
         elements.append(Spacer(1, 20))
 
         total_data = [
@@ -494,7 +664,7 @@ class DataService:
 
         doc.build(elements)
         logging.info("Relatório PDF gerado com sucesso.")
-        return filename
+        return buffer.getvalue()
 
     def consultar_siafi(self, usuario, senha, api_key=None):
         """Consulta o SIAFI com autenticação (simulada para testes)."""
@@ -0,0 +1,152 @@
+"""Estrutura do banco de dados, compartilhada por app.py e data_service.py."""
+
+# Versão da estrutura criada por DDL_SCRIPT: deve ser incrementada a cada alteração do script,
+# para que bancos já existentes o executem novamente
+SCHEMA_VERSION = 2
+
+# Estrutura completa do banco, enviada em um único execute: um só parse e tudo na mesma transação
+DDL_SCRIPT = """
+    CREATE TABLE IF NOT EXISTS planos_internos (
+        codigo TEXT PRIMARY KEY
+    );
+    CREATE TABLE IF NOT EXISTS naturezas_despesa (
+        codigo TEXT PRIMARY KEY,
+        plano_interno_codigo TEXT,
+        FOREIGN KEY (plano_interno_codigo) REFERENCES planos_internos (codigo) ON DELETE CASCADE
+    );
+    CREATE TABLE IF NOT EXISTS secoes_requisitantes (
+        codigo TEXT PRIMARY KEY
+    );
+    CREATE TABLE IF NOT EXISTS notas (
+        numero TEXT PRIMARY KEY,
+        valor NUMERIC(14,2),
+        valor_restante NUMERIC(14,2),
+        descricao TEXT,
+        observacao TEXT,
+        prazo TEXT,
+        data_criacao TEXT,
+        natureza_despesa_codigo TEXT,
+        plano_interno_codigo TEXT,
+        ptres_codigo TEXT,
+        fonte_codigo TEXT,
+        FOREIGN KEY (natureza_despesa_codigo) REFERENCES naturezas_despesa (codigo) ON DELETE CASCADE,
+        FOREIGN KEY (plano_interno_codigo) REFERENCES planos_internos (codigo) ON DELETE CASCADE
+    );
+    CREATE TABLE IF NOT EXISTS empenhos (
+        id SERIAL PRIMARY KEY,
+        numero_nota TEXT,
+        valor NUMERIC(14,2),
+        descricao TEXT,
+        data TEXT,
+        secao_requisitante_codigo TEXT,
+        FOREIGN KEY (numero_nota) REFERENCES notas (numero) ON DELETE CASCADE,
+        FOREIGN KEY (secao_requisitante_codigo) REFERENCES secoes_requisitantes (codigo) ON DELETE SET NULL
+    );
+    -- Migra bancos criados com REAL para NUMERIC: valores exatos e somas sem erro acumulado
+    DO $$
+    BEGIN
+        IF EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name IN ('notas', 'empenhos')
+              AND column_name IN ('valor', 'valor_restante') AND data_type = 'real'
+        ) THEN
+            ALTER TABLE notas
+                ALTER COLUMN valor TYPE NUMERIC(14,2) USING valor::numeric(14,2),
+                ALTER COLUMN valor_restante TYPE NUMERIC(14,2) USING valor_restante::numeric(14,2);
+            ALTER TABLE empenhos
+                ALTER COLUMN valor TYPE NUMERIC(14,2) USING valor::numeric(14,2);
+        END IF;
+    END $$;
+    -- Índices das chaves estrangeiras usadas nos filtros e no JOIN dos relatórios
+    CREATE INDEX IF NOT EXISTS idx_notas_nd ON notas (natureza_despesa_codigo);
+    CREATE INDEX IF NOT EXISTS idx_notas_pi ON notas (plano_interno_codigo);
+    CREATE INDEX IF NOT EXISTS idx_emp_nota ON empenhos (numero_nota);
+    CREATE INDEX IF NOT EXISTS idx_emp_secao ON empenhos (secao_requisitante_codigo);
+    CREATE INDEX IF NOT EXISTS idx_notas_dc ON notas (data_criacao DESC);
+    CREATE INDEX IF NOT EXISTS idx_nd_pi ON naturezas_despesa (plano_interno_codigo);
+    -- Saldo nunca negativo: empenhos acima do saldo falham atomicamente no UPDATE do trigger de empenhos.
+    -- NOT VALID preserva bancos com dados legados, validando apenas as novas escritas
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'notas_valor_restante_check') THEN
+            ALTER TABLE notas ADD CONSTRAINT notas_valor_restante_check
+                CHECK (valor_restante >= 0) NOT VALID;
+        END IF;
+    END $$;
+    -- O saldo da nota é mantido pelo próprio banco a cada empenho inserido ou excluído
+    CREATE OR REPLACE FUNCTION trg_empenho_maintain() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE notas SET valor_restante = valor_restante - NEW.valor WHERE numero = NEW.numero_nota;
+        ELSIF TG_OP = 'DELETE' THEN
+            UPDATE notas SET valor_restante = valor_restante + OLD.valor WHERE numero = OLD.numero_nota;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'empenhos_valor_restante') THEN
+            CREATE TRIGGER empenhos_valor_restante AFTER INSERT OR DELETE ON empenhos
+                FOR EACH ROW EXECUTE FUNCTION trg_empenho_maintain();
+        END IF;
+    END $$;
+    -- O plano interno da nota é sempre o da sua natureza da despesa:
+    -- os relatórios leem n.plano_interno_codigo sem passar pela natureza
+    CREATE OR REPLACE FUNCTION trg_nota_plano_sync() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.natureza_despesa_codigo IS NOT NULL THEN
+            SELECT plano_interno_codigo INTO NEW.plano_interno_codigo
+            FROM naturezas_despesa WHERE codigo = NEW.natureza_despesa_codigo;
+        END IF;
+        RETURN NEW;
+    END $$ LANGUAGE plpgsql;
+    CREATE OR REPLACE FUNCTION trg_natureza_plano_sync() RETURNS trigger AS $$
+    BEGIN
+        UPDATE notas SET plano_interno_codigo = NEW.plano_interno_codigo
+        WHERE natureza_despesa_codigo = NEW.codigo;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'notas_plano_sync') THEN
+            CREATE TRIGGER notas_plano_sync
+                BEFORE INSERT OR UPDATE OF natureza_despesa_codigo, plano_interno_codigo ON notas
+                FOR EACH ROW EXECUTE FUNCTION trg_nota_plano_sync();
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'naturezas_plano_sync') THEN
+            CREATE TRIGGER naturezas_plano_sync
+                AFTER UPDATE OF plano_interno_codigo ON naturezas_despesa
+                FOR EACH ROW EXECUTE FUNCTION trg_natureza_plano_sync();
+        END IF;
+    END $$;
+    -- Corrige notas gravadas antes dos triggers com um plano diferente do da natureza
+    UPDATE notas n SET plano_interno_codigo = nd.plano_interno_codigo
+    FROM naturezas_despesa nd
+    WHERE nd.codigo = n.natureza_despesa_codigo
+      AND n.plano_interno_codigo IS DISTINCT FROM nd.plano_interno_codigo;
+"""
+
+# Chave do pg_advisory_xact_lock que serializa a inicialização da estrutura entre processos
+_TRAVA_ESQUEMA = 7410001
+
+def aplicar_esquema(conn):
+    """Executa DDL_SCRIPT na transação da conexão se a versão registrada no banco for anterior a SCHEMA_VERSION.
+
+    Retorna True se o script foi executado; a transação é confirmada pelo chamador, o que também libera a trava."""
+    with conn.cursor() as c:
+        # Processos que iniciam ao mesmo tempo esperam aqui: só o primeiro executa o script,
+        # os demais já encontram a versão atual registrada
+        c.execute("SELECT pg_advisory_xact_lock(%s)", (_TRAVA_ESQUEMA,))
+        # Sentinela: a versão registrada no banco já é a do script atual
+        c.execute("SELECT to_regclass('versao_esquema') IS NOT NULL")
+        if c.fetchone()[0]:
+            c.execute("SELECT COALESCE(MAX(versao), 0) FROM versao_esquema")
+            if c.fetchone()[0] >= SCHEMA_VERSION:
+                return False
+        c.execute(DDL_SCRIPT)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS versao_esquema (versao INTEGER NOT NULL);
+            DELETE FROM versao_esquema;
+            INSERT INTO versao_esquema (versao) VALUES (%s);
+        """, (SCHEMA_VERSION,))
+    return True